@@ -0,0 +1,155 @@
+# Benchmark for cleaning scraped CSV files, comparing the original converter-based
+# _clean_listings with the vectorized one in scraper2/cleaning.py. Geocoding isn't
+# included, since it doesn't depend on how the rows are cleaned.
+#
+# Usage: python bench_cleaning.py [scraped.csv ...]
+#
+# With no arguments it uses the files in NLP/sample_output. Those come from the shared
+# room scraper and have no beds or baths columns, so empty ones are added. Each file is
+# also tiled to about SCALE_ROWS rows, with new pids, to time regional-sized files.
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# add subfolder to system path
+sys.path.insert(0, 'scraper2/')
+
+import cleaning
+
+SCALE_ROWS = 50000
+REPEAT = 3
+
+
+def legacy_to_float(string_value):
+    string_value = string_value.strip()
+    return np.float(string_value) if string_value else np.nan
+
+
+def legacy_clean(filename):
+    '''
+    RentalListingScraper._clean_listings, up to geocoding, as it was before cleaning.py.
+    '''
+    converters = {'neighb':str,
+          'title':str,
+          'price':legacy_to_float,
+          'beds':legacy_to_float,
+          'baths':legacy_to_float,
+          'pid':str,
+          'dt':str,
+          'url':str,
+          'sqft':legacy_to_float,
+          'sourcepage':str,
+          'lng':legacy_to_float,
+          'lat':legacy_to_float}
+
+    all_listings = pd.read_csv(filename, converters=converters)
+
+    if len(all_listings) == 0:
+        return None, 0, 0
+    all_listings = all_listings.rename(columns={'price':'rent', 'dt':'date', 'beds':'bedrooms', 'neighb':'neighborhood',
+                                                'baths':'bathrooms','lng':'longitude', 'lat':'latitude'})
+    all_listings['rent_sqft'] = all_listings['rent'] / all_listings['sqft']
+    all_listings['date'] = pd.to_datetime(all_listings['date'], format='%Y-%m-%d')
+    all_listings['day_of_week'] = all_listings['date'].apply(lambda x: x.weekday())
+    all_listings['region'] = all_listings['url'].str.extract('http://(.*).craigslist.org', expand=False)
+    unique_listings = pd.DataFrame(all_listings.drop_duplicates(subset='pid', inplace=False))
+    thorough_listings = pd.DataFrame(unique_listings)
+    thorough_listings = thorough_listings[thorough_listings['rent'] > 0]
+    thorough_listings = thorough_listings[thorough_listings['sqft'] > 0]
+    if len(thorough_listings) == 0:
+        return None, 0, 0
+
+    geolocated_filtered_listings = pd.DataFrame(thorough_listings)
+    geolocated_filtered_listings = geolocated_filtered_listings[pd.notnull(geolocated_filtered_listings['latitude'])]
+    geolocated_filtered_listings = geolocated_filtered_listings[pd.notnull(geolocated_filtered_listings['longitude'])]
+    cols = ['pid', 'date', 'region', 'neighborhood', 'rent', 'bedrooms', 'sqft', 'rent_sqft', 'bathrooms',
+            'longitude', 'latitude']
+    data_output = geolocated_filtered_listings[cols]
+
+    return data_output, len(all_listings), len(thorough_listings)
+
+
+def new_clean(filename):
+    '''
+    The same steps as RentalListingScraper._clean_frame() up to geocoding.
+    '''
+    all_listings = cleaning.read_listings(filename)
+    if len(all_listings) == 0:
+        return None, 0, 0
+    data_output, count_listings, count_thorough = cleaning.clean_listings(all_listings)
+    if count_thorough == 0:
+        return None, 0, 0
+    return data_output, count_listings, count_thorough
+
+
+def prepare(fname, out_dir, scale):
+    '''
+    Copies a scraped file to out_dir with the columns the rental scraper writes,
+    optionally tiled up to scale rows. Returns the new file name.
+    '''
+    listings = pd.read_csv(fname, dtype=str, na_filter=False)
+    for col in ['pid', 'dt', 'url', 'title', 'price', 'neighb', 'beds', 'sqft', 'baths',
+                'lat', 'lng', 'accuracy', 'address']:
+        if col not in listings:
+            listings[col] = ''
+
+    if scale and len(listings) > 0:
+        copies = max(1, scale // len(listings))
+        tiles = []
+        for i in range(copies):
+            tile = listings.copy()
+            tile['pid'] = [str(int(pid) + i * 10 ** 10) if pid.isdigit() else pid
+                           for pid in tile['pid']]
+            tiles.append(tile)
+        listings = pd.concat(tiles, ignore_index=True)
+
+    out = os.path.join(out_dir, '{0}-{1}'.format(scale, os.path.basename(fname)))
+    listings.to_csv(out, index=False, encoding='utf-8')
+    return out
+
+
+def check(fname):
+
+    old, old_listings, old_thorough = legacy_clean(fname)
+    new, new_listings, new_thorough = new_clean(fname)
+    assert (old_listings, old_thorough) == (new_listings, new_thorough), fname
+    if old is None:
+        assert new is None, fname
+    else:
+        pd.util.testing.assert_frame_equal(old, new, check_exact=True)
+
+
+def bench(clean, fnames):
+
+    st = time.time()
+    for _ in range(REPEAT):
+        for fname in fnames:
+            clean(fname)
+    return (time.time() - st) / REPEAT
+
+
+fnames = sys.argv[1:] or sorted(glob.glob('NLP/sample_output/*.csv'))
+tmp_dir = tempfile.mkdtemp()
+
+try:
+    originals = [prepare(fname, tmp_dir, 0) for fname in fnames]
+    scaled = [prepare(fname, tmp_dir, SCALE_ROWS) for fname in fnames]
+
+    for fname in originals + scaled:
+        check(fname)
+
+    num_rows = sum(len(pd.read_csv(fname, usecols=['pid'])) for fname in scaled)
+    before = bench(legacy_clean, scaled)
+    after = bench(new_clean, scaled)
+finally:
+    shutil.rmtree(tmp_dir)
+
+print("Cleaned {0} rows in {1} files, results identical".format(num_rows, len(scaled)))
+print("Before: {0:.0f} rows/second".format(num_rows / before))
+print("After: {0:.0f} rows/second ({1:.1f}x)".format(num_rows / after, before / after))
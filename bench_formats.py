@@ -0,0 +1,78 @@
+# Benchmark for loading archived regional data files, comparing the CSV files the
+# scrapers write by default with the Parquet files from scraper2/sinks.py.
+#
+# Usage: python bench_formats.py [scraped_roo.csv ...]
+#
+# With no arguments it uses the shared room files in NLP/sample_output. They are
+# converted to Parquet with sinks.ParquetSink, and COPIES of each stand in for a month
+# of archives. Loads are timed for all columns, and for the few columns an analysis of
+# rents would use.
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unicodecsv as csv
+
+# add subfolder to system path
+sys.path.insert(0, 'scraper2/')
+
+import sinks
+
+COPIES = 30
+COLUMNS = ['pid', 'dt', 'price', 'neighb', 'lat', 'lng']
+COLNAMES = [name for name, kind in sinks.ROO_SCHEMA]
+
+
+def convert(fname, out_dir):
+    '''
+    Writes the rows of a scraped CSV file to a CSV and a Parquet file in out_dir, with
+    the roo scraper's columns. Returns the two file names.
+    '''
+    base = os.path.join(out_dir, os.path.basename(fname)[:-4])
+    with open(fname, 'rb') as f:
+        reader = csv.DictReader(f)
+        with sinks.open_sink('csv', base + '.csv', COLNAMES, sinks.ROO_SCHEMA) as csv_out:
+            with sinks.open_sink('parquet', base + '.parquet', COLNAMES, sinks.ROO_SCHEMA,
+                                 region='sfbay') as parquet_out:
+                for row in reader:
+                    row = [row.get(col, '') for col in COLNAMES]
+                    csv_out.writerow(row)
+                    parquet_out.writerow(row)
+    return base + '.csv', base + '.parquet'
+
+
+def bench(fnames, columns=None):
+
+    st = time.time()
+    listings = sinks.read_files(fnames, columns)
+    return time.time() - st, len(listings)
+
+
+fnames = sys.argv[1:] or sorted(glob.glob('NLP/sample_output/*.csv'))
+tmp_dir = tempfile.mkdtemp()
+
+try:
+    converted = [convert(fname, tmp_dir) for fname in fnames]
+    csv_files = [c for c, p in converted] * COPIES
+    parquet_files = [p for c, p in converted] * COPIES
+
+    csv_size = sum(os.path.getsize(c) for c, p in converted)
+    parquet_size = sum(os.path.getsize(p) for c, p in converted)
+
+    results = []
+    for label, columns in [('all columns', None), ('{0} columns'.format(len(COLUMNS)), COLUMNS)]:
+        csv_time, num_rows = bench(csv_files, columns)
+        parquet_time, parquet_rows = bench(parquet_files, columns)
+        assert num_rows == parquet_rows
+        results.append((label, num_rows, csv_time, parquet_time))
+finally:
+    shutil.rmtree(tmp_dir)
+
+print("Size on disk: {0:.1f} MB as CSV, {1:.1f} MB as Parquet".format(
+    csv_size / 1e6, parquet_size / 1e6))
+for label, num_rows, csv_time, parquet_time in results:
+    print("{0} rows, {1}: CSV {2:.2f}s, Parquet {3:.2f}s ({4:.1f}x)".format(
+        num_rows, label, csv_time, parquet_time, csv_time / parquet_time))
@@ -0,0 +1,117 @@
+# Microbenchmark for parsing pages of search results, comparing the original
+# xpath-per-field parser with the precompiled one in scraper2/resultparser.py.
+#
+# Usage: python bench_parser.py [saved_results_page.html ...]
+#
+# With no arguments it uses a synthetic page of 120 rows in Craigslist's markup.
+
+from datetime import datetime as dt
+from datetime import timedelta
+import time
+import sys
+from lxml import html
+
+# add subfolder to system path
+sys.path.insert(0, 'scraper2/')
+
+import resultparser
+
+REPEAT = 20
+
+
+def legacy_get_int_prefix(str, label):
+    for s in str.split(' '):
+        if label in s:
+            return s.strip(label)
+    return 0
+
+
+def legacy_parse(item):
+    '''
+    RentalListingScraper._parseListing and the timestamp parsing from run(), as they
+    were before the precompiled parser.
+    '''
+    pid = item.xpath('@data-pid')[0]
+    info = item.xpath('p[@class="result-info"]')[0]
+    ts = info.xpath('time/@datetime')[0]
+    url = info.xpath('a/@href')[0]
+    if type(info.xpath('a/text()')) == str:
+        title = info.xpath('a/text()')
+    else:
+        title = info.xpath('a/text()')[0]
+    price = info.xpath('span[@class="result-meta"]/span[@class="result-price"]/text()')
+    price = price[0].strip('$') if len(price) > 0 else ''
+    neighb_raw = info.xpath('span[@class="result-meta"]/span[@class="result-hood"]/text()')
+    if len(neighb_raw) == 0:
+        neighb = ''
+    else:
+        neighb = neighb_raw[0].strip(" ").strip("(").strip(")")
+    housing_raw = info.xpath('span[@class="result-meta"]/span[@class="housing"]/text()')
+    if len(housing_raw) == 0:
+        beds = 0
+        sqft = 0
+    else:
+        bedsqft = housing_raw[0]
+        beds = legacy_get_int_prefix(bedsqft, "br")
+        sqft = legacy_get_int_prefix(bedsqft, "ft")
+    row = [pid, ts, url, title, price, neighb, beds, sqft]
+    dt.strptime(row[1], '%Y-%m-%d %H:%M')
+    return row
+
+
+def new_parse(item):
+    row = resultparser.parse_result_row(item)
+    resultparser.parse_timestamp(row[1])
+    return row
+
+
+def synthetic_page(num_rows=120):
+
+    now = dt.now()
+    rows = []
+    for i in range(num_rows):
+        pid = 6000000000 + i
+        ts = (now - timedelta(minutes=i // 3)).strftime('%Y-%m-%d %H:%M')
+        price = '<span class="result-price">${0}</span>'.format(1000 + i) if i % 7 else ''
+        housing = ('<span class="housing">\n {0}br -\n {1}ft<sup>2</sup> -\n </span>'.format(1 + i % 3, 500 + i)
+                   if i % 5 else '')
+        rows.append(
+            '<li class="result-row" data-pid="{0}">'
+            '<a href="/sfc/apa/{0}.html" class="result-image gallery"></a>'
+            '<p class="result-info"><span class="icon icon-star"></span>'
+            '<time class="result-date" datetime="{1}" title="">Mar 1</time>'
+            '<a href="/sfc/apa/{0}.html" data-id="{0}" class="result-title hdrlnk">Listing number {2}</a>'
+            '<span class="result-meta">{3}{4}<span class="result-hood"> (mission district)</span>'
+            '</span></p></li>'.format(pid, ts, i, price, housing))
+    return '<html><body><ul class="rows">' + ''.join(rows) + '</ul></body></html>'
+
+
+def bench(parse, pages):
+
+    num_rows = 0
+    st = time.time()
+    for _ in range(REPEAT):
+        for tree in pages:
+            for item in resultparser.RESULT_ROWS(tree):
+                parse(item)
+                num_rows += 1
+    return num_rows / (time.time() - st)
+
+
+if len(sys.argv) > 1:
+    pages = [html.fromstring(open(fname, 'rb').read()) for fname in sys.argv[1:]]
+else:
+    pages = [html.fromstring(synthetic_page())]
+
+# The new parser returns ints where the old one returned strings of digits
+for tree in pages:
+    for item in resultparser.RESULT_ROWS(tree):
+        old = [str(x) for x in legacy_parse(item)]
+        new = [str(x) for x in new_parse(item)]
+        assert old == new, (old, new)
+
+before = bench(legacy_parse, pages)
+after = bench(new_parse, pages)
+
+print("Before: {0:.0f} rows/second".format(before))
+print("After: {0:.0f} rows/second ({1:.1f}x)".format(after, after / before))
@@ -0,0 +1,122 @@
+# End-to-end benchmark for the scrapers, run against the local stand-in for Craigslist
+# in replay_server.py, so it doesn't use any of the real request budget.
+#
+# Usage: python bench_scraper.py [apa] [roo] [--pages CACHE_DIR] [--db]
+#
+# Each scraper crawls DOMAINS synthetic regions of LISTINGS listings each, in a child
+# process of its own so that its peak memory can be measured. Reports listings scraped
+# per second, requests per listing and peak RSS. Database writes are skipped unless
+# --db is given, and geocoding goes to the stand-in's copy of the FCC API. The server
+# settings below can make responses slow, flaky or throttled.
+
+from __future__ import division
+from __future__ import print_function
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+from datetime import timedelta
+
+# add subfolders to system path
+sys.path.insert(0, 'scraper2/')
+sys.path.insert(0, 'shared_room_scraper/')
+
+import replay_server
+
+DOMAINS = ['sfbay', 'seattle', 'modesto', 'olympic']
+LISTINGS = 500  # per region and category
+INTERVAL = 60  # seconds between listings
+
+SERVER_SETTINGS = dict(latency=0.02, jitter=0.02, error_rate=0.0, throttle_rate=None)
+
+# Passed to both scrapers. Pacing is off, since it would only measure the rate limit.
+SCRAPER_SETTINGS = dict(rate_limit=None, cache_dir=None, seen_pids=None, checkpoint_dir=None,
+                        fips_cache=None)
+
+
+def make_scraper(name, out_dir, write_db):
+
+    earliest_ts = dt.now() - timedelta(seconds=LISTINGS * INTERVAL + 3600)
+    latest_ts = dt.now() + timedelta(hours=1)
+
+    if name == 'apa':
+        import scraper2
+        cls = scraper2.RentalListingScraper
+        if not write_db:
+            cls = type('OfflineScraper', (cls,), {
+                '_write_db': lambda self, dataframe, domain, category=None: ([], [], list(dataframe['pid']))})
+        domains = ['http://{0}.craigslist.org/search/apa'.format(d) for d in DOMAINS]
+        return cls(domains=domains, earliest_ts=earliest_ts, latest_ts=latest_ts,
+                   out_dir=out_dir, fname_ts='bench', shard=False, **SCRAPER_SETTINGS)
+
+    if name == 'roo':
+        import roodata_to_database
+        domains = ['http://{0}.craigslist.org/search/roo'.format(d) for d in DOMAINS]
+        return roodata_to_database.RentalListingScraper(
+            domains=domains, earliest_ts=earliest_ts, latest_ts=latest_ts,
+            out_dir=out_dir, fname_ts='bench', **SCRAPER_SETTINGS)
+
+    raise ValueError('Unknown scraper {0}, use apa or roo'.format(name))
+
+
+def run_scraper(name, proxy_url, out_dir, write_db, results):
+    '''
+    Runs one scraper in this process, going through the stand-in as its proxy, and puts
+    its numbers on the results queue.
+    '''
+    os.environ['HTTP_PROXY'] = os.environ['http_proxy'] = proxy_url
+    os.environ['NO_PROXY'] = os.environ['no_proxy'] = ''
+
+    scraper = make_scraper(name, out_dir, write_db)
+    st = time.time()
+    stats = scraper.run(charity_proxy=False)
+    elapsed = time.time() - st
+
+    results.put({
+        'seconds': elapsed,
+        'listings': sum(s.get('listings', 0) for s in stats),
+        'rows': sum(s.get('rows', 0) for s in stats),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+
+def bench(name, server, write_db):
+
+    out_dir = tempfile.mkdtemp() + '/'
+    results = multiprocessing.Queue()
+    server.reset_counts()
+    try:
+        worker = multiprocessing.Process(target=run_scraper,
+                                         args=(name, server.url, out_dir, write_db, results))
+        worker.start()
+        result = results.get()
+        worker.join()
+    finally:
+        shutil.rmtree(out_dir)
+
+    result['requests'] = sum(n for kind, n in server.counts.items() if kind != 'fcc')
+    result['counts'] = dict(server.counts)
+    return result
+
+
+args = sys.argv[1:]
+write_db = '--db' in args
+pages_dir = args[args.index('--pages') + 1] if '--pages' in args else None
+names = [a for a in args if a in ('apa', 'roo')] or ['apa', 'roo']
+
+server = replay_server.start(listings=LISTINGS, interval=INTERVAL, pages_dir=pages_dir,
+                             **SERVER_SETTINGS)
+try:
+    for name in names:
+        result = bench(name, server, write_db)
+        print("{0}: {1} rows from {2} listings in {3:.1f} seconds".format(
+            name, result['rows'], result['listings'], result['seconds']))
+        print("    {0:.1f} listings/s, {1:.2f} requests per listing, peak RSS {2:.0f} MB".format(
+            result['rows'] / result['seconds'], result['requests'] / max(result['rows'], 1),
+            result['peak_rss_mb']))
+        print("    requests: " + ', '.join('{0} {1}'.format(k, v) for k, v in sorted(result['counts'].items())))
+finally:
+    server.shutdown()
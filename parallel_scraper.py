@@ -4,12 +4,13 @@ from datetime import timedelta
 import time
 import sys
 import os
-import multiprocessing
 import shutil
 import subprocess
 import glob
 sys.path.insert(0, '/home/mgardner/scraper2/scraper2')
 import scraper2
+import scheduler
+import seenpids
 
 # add subfolder to system path
 
@@ -20,36 +21,52 @@ with open('/home/mgardner/scraper2/domains.txt', 'rb') as f:
 
 # domains = ['http://losangeles.craigslist.org/search/apa']
 
+# Run this every 15 minutes. Each region is only crawled when it's due, from where its
+# last crawl stopped, based on how fast new listings show up there (see scheduler.py).
+# Regions crawled for the first time look back this far.
 lookback = 1  # hours
 
 earliest_ts = dt.now() - timedelta(hours=lookback)
 latest_ts = dt.now() + timedelta(hours=0)
 ts = dt.now().strftime('%Y%m%d-%H%M%S')
 
-jobs = []
+num_workers = 16  # domains crawled at the same time
 
-st_time = time.time()
-for domain in domains:
-    s = scraper2.RentalListingScraper(
-        domains=[domain],
+# Add 'roo' to crawl shared rooms too, in the same worker as each region's apartments
+categories = ['apa']
+
+# Set to a directory to profile the workers, when some regions are unexpectedly slow.
+# Each run writes a combined cProfile report and a collapsed stack file for flame graphs
+# to a new subdirectory there.
+profile_dir = None
+
+# Index the listings we already have in the database, so the workers can skip them.
+# Not the data files, which also have listings that were dropped in cleaning or never
+# loaded, and would then never be tried again.
+seen_fname = '/home/mgardner/scraper2/logs/seen_pids.npy'
+num_seen = seenpids.build_index(seen_fname, scraper2.DB_CONN_STR, scraper2.DB_TABLE)
+print("Skipping {0} listings we already have.".format(num_seen))
+
+results = scheduler.run_domains(
+    scraper2.RentalListingScraper,
+    domains,
+    scraper_kwargs=dict(
         earliest_ts=earliest_ts,
         latest_ts=latest_ts,
-        fname_ts=ts)
-    print 'Starting process for ' + domain
-    p = multiprocessing.Process(target=s.run)
-    jobs.append(p)
-    p.start()
+        fname_ts=ts,
+        seen_pids=seen_fname,
+        categories=categories),
+    workers=num_workers,
+    history_fname='/home/mgardner/scraper2/logs/domain_stats.json',
+    adaptive=True,
+    metrics_fname='/home/mgardner/scraper2/logs/metrics.prom',
+    log_fname='/home/mgardner/scraper2/logs/scrape-' + ts + '.jsonl',
+    profile_dir=profile_dir,
+    progress_fname='/home/mgardner/scraper2/logs/progress.json')
 
-for i, job in enumerate(jobs):
-    job.join()
-    end_time = time.time()
-    elapsed_time = end_time - st_time
-    time_per_domain = elapsed_time / (i + 1.0)
-    num_domains = len(jobs)
-    domains_left = num_domains - (i + 1.0)
-    time_left = domains_left * time_per_domain
-    print("Took {0} seconds for {1} regions.".format(elapsed_time, i + 1))
-    print("About {0} seconds left.".format(time_left))
+failed = [r['domain'] for r in results if r['status'] != 'ok']
+if len(failed) > 0:
+    print("Failed regions: " + ', '.join(failed))
 
 # archive the data and delete the raw files
 print("Archiving data.")
@@ -57,7 +74,7 @@ print("Archiving data.")
 shutil.make_archive('/home/mgardner/scraper2/archives/rental_listings-' + ts,
                     'zip', '/home/mgardner/scraper2/data')
 [os.remove(x) for x in glob.glob("/home/mgardner/scraper2/data/*" +
-                                 ts + ".csv")]
+                                 ts + ".*")]
 
 # run the sync script to send the archive to box, delete local copy of archive
 p = subprocess.Popen(['. /home/mgardner/scraper2/sync_data.sh'], shell=True,
@@ -4,12 +4,14 @@ from datetime import timedelta
 import time
 import sys
 import os
-import multiprocessing
 import shutil
 import subprocess
 import glob
 sys.path.insert(0, './shared_room_scraper')
+sys.path.insert(0, './scraper2')
 import roodata_to_database
+import scheduler
+import seenpids
 
 # add subfolder to system path
 
@@ -26,30 +28,27 @@ earliest_ts = dt.now() - timedelta(hours=lookback)
 latest_ts = dt.now() + timedelta(hours=1)
 ts = dt.now().strftime('%Y%m%d-%H%M%S')
 
-jobs = []
+num_workers = 16  # domains crawled at the same time
 
-st_time = time.time()
-for domain in domains:
-    s = roodata_to_database.RentalListingScraper(    #is ours RentalListingScraper?
-        domains=[domain],
+# Index the listings in earlier data files, so the workers can skip them
+seen_fname = './shared_room_scraper/logs/seen_pids.npy'
+num_seen = seenpids.build_index(seen_fname, csv_pattern='./shared_room_scraper/data/*.csv')
+print("Skipping {0} listings we already have.".format(num_seen))
+
+results = scheduler.run_domains(
+    roodata_to_database.RentalListingScraper,
+    domains,
+    scraper_kwargs=dict(
         earliest_ts=earliest_ts,
         latest_ts=latest_ts,
-        fname_ts=ts)
-    print ('Starting process for ' + domain)
-    p = multiprocessing.Process(target=s.run)
-    jobs.append(p)
-    p.start()
+        fname_ts=ts,
+        seen_pids=seen_fname),
+    workers=num_workers,
+    history_fname='./shared_room_scraper/logs/domain_stats.json')
 
-for i, job in enumerate(jobs):
-    job.join()
-    end_time = time.time()
-    elapsed_time = end_time - st_time
-    time_per_domain = elapsed_time / (i + 1.0)
-    num_domains = len(jobs)
-    domains_left = num_domains - (i + 1.0)
-    time_left = domains_left * time_per_domain
-    print("Took {0} seconds for {1} regions.".format(elapsed_time, i + 1))
-    print("About {0} seconds left.".format(time_left))
+failed = [r['domain'] for r in results if r['status'] != 'ok']
+if len(failed) > 0:
+    print("Failed regions: " + ', '.join(failed))
 
 # archive the data and delete the raw files
 # print("Archiving data.")
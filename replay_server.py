@@ -0,0 +1,352 @@
+# Local stand-in for Craigslist, for running the scrapers offline. It's an HTTP
+# forward proxy: point HTTP_PROXY at it and run the scrapers with charity_proxy=False,
+# and every request for a *.craigslist.org page is answered here instead.
+#
+# Usage: python replay_server.py [--port 8765] [--listings 1000] [--latency 0.05] ...
+#
+# Search pages are generated, with LISTINGS_PER_SEARCH listings for each region and
+# category, posted INTERVAL seconds apart up to when the server started. Listing pages
+# are generated too, or replayed from a page cache directory filled by earlier runs
+# (see scraper2/pagecache.py), in which case the searches list the cached pids. The
+# FCC census block API is answered as well, so geocoding stays offline.
+#
+# Responses can be slowed down, fail at random, and be blocked like Craigslist does
+# when requests come in faster than the throttle rate. See bench_scraper.py.
+
+from __future__ import division
+from __future__ import print_function
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime as dt
+from datetime import timedelta
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl
+
+# add subfolder to system path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scraper2'))
+
+import pagecache
+import shards
+
+LISTINGS_PER_SEARCH = 1000
+INTERVAL = 60  # seconds between listings
+PAGE_SIZE = 120  # results per search page, as on Craigslist
+
+LATENCY = 0.0  # seconds added to every response
+JITTER = 0.0  # up to this many more seconds, at random
+ERROR_RATE = 0.0  # fraction of requests answered with a 503
+
+# Requests per second above which requests are blocked with a 403 and Craigslist's block
+# page, with BURST requests allowed back to back. None turns throttling off.
+THROTTLE_RATE = None
+BURST = 10
+
+BLOCK_PAGE = (b'<html><body><p>This IP has been automatically blocked.</p>'
+              b'<p>If you have questions, please email: blocks-b1@craigslist.org</p></body></html>')
+
+ATTRIBUTES = ['furnished', 'w/d in unit', 'laundry in bldg', 'no laundry on site', 'private room',
+              'private bath', 'no private bath', 'street parking', 'off-street parking',
+              'attached garage', 'carport', 'no parking', 'cats are OK - purrr', 'no smoking']
+
+
+class Listings(object):
+    '''
+    The synthetic listings of one search, newest first. Each listing's fields are
+    derived from its pid, so the same server settings always give the same pages.
+    '''
+
+    def __init__(self, region, category, count, interval, start, pids=None):
+
+        self.region = region
+        self.category = category
+        offset = (sum(ord(c) for c in region + category) % 1000) * 10 ** 6
+        self.pids = pids if pids is not None else [7000000000 + offset + i for i in range(count)]
+        subareas = shards.SUBAREAS.get(region, [])
+        self.rows = []
+        for i, pid in enumerate(self.pids):
+            rng = random.Random(pid)
+            self.rows.append({
+                'pid': pid,
+                'ts': start - timedelta(seconds=i * interval),
+                'subarea': rng.choice(subareas) if subareas else None,
+                'price': rng.randrange(500, 8000) if rng.random() > 0.05 else None,
+                'beds': rng.randrange(0, 5) if rng.random() > 0.2 else None,
+                'sqft': rng.randrange(200, 3000) if rng.random() > 0.3 else None,
+                'hood': 'hood {0}'.format(rng.randrange(40))})
+
+
+    def search(self, subarea, query, cap):
+        '''
+        Returns the listings matching a search, and the total number of matches.
+        '''
+        low = int(query['min_price']) if query.get('min_price', '').isdigit() else None
+        high = int(query['max_price']) if query.get('max_price', '').isdigit() else None
+        rows = [row for row in self.rows
+                if (subarea is None or row['subarea'] == subarea)
+                and (low is None or (row['price'] is not None and row['price'] >= low))
+                and (high is None or (row['price'] is not None and row['price'] <= high))]
+        return rows[:cap], len(rows)
+
+
+def _search_row(row, category):
+
+    href = '/{0}{1}/{2}.html'.format(row['subarea'] + '/' if row['subarea'] else '', category, row['pid'])
+    meta = ''
+    if row['price'] is not None:
+        meta += '<span class="result-price">${0}</span>'.format(row['price'])
+    if row['beds'] is not None or row['sqft'] is not None:
+        meta += '<span class="housing">\n {0}{1}- </span>'.format(
+            '{0}br -\n '.format(row['beds']) if row['beds'] is not None else '',
+            '{0}ft<sup>2</sup> -\n '.format(row['sqft']) if row['sqft'] is not None else '')
+    meta += '<span class="result-hood"> ({0})</span>'.format(row['hood'])
+    return ('<li class="result-row" data-pid="{pid}"><a href="{href}" class="result-image gallery"></a>'
+            '<p class="result-info"><span class="icon icon-star"></span>'
+            '<time class="result-date" datetime="{ts}" title="{ts}">{day}</time>'
+            '<a href="{href}" data-id="{pid}" class="result-title hdrlnk">Listing {pid}</a>'
+            '<span class="result-meta">{meta}</span></p></li>').format(
+                pid=row['pid'], href=href, ts=row['ts'].strftime('%Y-%m-%d %H:%M'),
+                day=row['ts'].strftime('%b %d'), meta=meta)
+
+
+def search_page(listings, path, query, cap):
+    '''
+    Returns a page of search results like Craigslist's, with a link to the next page.
+    '''
+    parts = [p for p in path.split('/') if p]  # ['search', 'sfc', 'apa'] or ['search', 'apa']
+    subarea = parts[1] if len(parts) > 2 else None
+    rows, total = listings.search(subarea, query, cap)
+    start = int(query.get('s', '0')) if query.get('s', '0').isdigit() else 0
+    page = rows[start:start + PAGE_SIZE]
+
+    next_link = ''
+    if start + PAGE_SIZE < len(rows):
+        next_query = '&'.join('{0}={1}'.format(k, v) for k, v in sorted(dict(query, s=start + PAGE_SIZE).items()))
+        next_link = '<a href="{0}?{1}" class="button next" title="next page"> next &gt; </a>'.format(
+            path, next_query)
+
+    return ('<html><head><title>search</title></head><body><section class="page-container">'
+            '<span class="button pagenum"><span class="rangeFrom">{0}</span> - '
+            '<span class="rangeTo">{1}</span> / <span class="totalcount">{2}</span></span>'
+            '<ul class="rows">{3}</ul>{4}</section></body></html>').format(
+                start + 1, start + len(page), total,
+                ''.join(_search_row(row, listings.category) for row in page), next_link).encode('utf-8')
+
+
+def listing_page(pid):
+    '''
+    Returns a listing page like Craigslist's, with the map, the attribute groups that
+    the apa and roo scrapers read, and the posting body.
+    '''
+    rng = random.Random(pid)
+    mapbox = ''
+    if rng.random() > 0.1:
+        mapbox = ('<div class="mapbox"><div id="map" class="viewposting" data-latitude="{0:.6f}" '
+                  'data-longitude="{1:.6f}" data-accuracy="{2}"></div>').format(
+                      rng.uniform(37.2, 38.0), rng.uniform(-122.6, -121.8), rng.choice([0, 10, 22]))
+        if rng.random() > 0.5:
+            mapbox += ('<p class="mapaddress">{0} Main St<small>(<a target="_blank" '
+                       'href="https://maps.google.com/maps/preview/@37.7,-122.4,16z?q=loc%3A+{0}+Main+St">'
+                       'google map</a>)</small></p>').format(rng.randrange(1, 2000))
+        mapbox += '</div>'
+
+    beds = '<span><b>{0}BR</b> / <b>{1}Ba</b></span>'.format(rng.randrange(0, 5), rng.choice([1, 1.5, 2]))
+    attrs = ''.join('<span>{0}</span>'.format(a) for a in ATTRIBUTES if rng.random() > 0.6)
+    body = ' '.join(rng.choice(['sunny', 'quiet', 'room', 'near transit', 'available now', 'large'])
+                    for i in range(rng.randrange(20, 200)))
+
+    return ('<html><head><title>{0}</title></head><body><section class="page-container">'
+            '<section class="body"><section class="userbody"><div class="mapAndAttrs">{1}'
+            '<p class="attrgroup">{2}</p><p class="attrgroup">{3}</p></div>'
+            '<section id="postingbody"><div class="print-qrcode-container"></div>{4}</section>'
+            '</section></section></section></body></html>').format(
+                pid, mapbox, beds, attrs, body).encode('utf-8')
+
+
+def fips_response(query):
+
+    return json.dumps({
+        'Block': {'FIPS': '06075{0:010d}'.format(zlib.crc32(query.get('latitude', '').encode('utf-8')) % 10 ** 10)},
+        'County': {'FIPS': '06075', 'name': 'San Francisco'},
+        'State': {'FIPS': '06', 'code': 'CA', 'name': 'California'},
+        'status': 'OK'}).encode('utf-8')
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+    def _send(self, status, content, content_type='text/html; charset=utf-8'):
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def do_GET(self):
+
+        server = self.server
+        scheme, host, path, query, fragment = urlsplit(self.path)
+        query = dict(parse_qsl(query))
+
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        if host == 'data.fcc.gov':
+            server.count('fcc')
+            return self._send(200, fips_response(query), 'application/json')
+
+        if server.throttled():
+            server.count('blocked')
+            return self._send(403, BLOCK_PAGE)
+
+        if random.random() < server.error_rate:
+            server.count('errors')
+            return self._send(503, b'<html><body>Service Unavailable</body></html>')
+
+        region = host.split('.')[0]
+        if path.startswith('/search/'):
+            server.count('search')
+            category = path.rstrip('/').split('/')[-1]
+            return self._send(200, search_page(server.listings(region, category), path, query,
+                                               server.result_cap))
+
+        pid = path.rstrip('/').split('/')[-1].split('.')[0]
+        if path.endswith('.html') and pid.isdigit():
+            server.count('detail')
+            content = server.cache.get(pid) if server.cache is not None else None
+            return self._send(200, content if content is not None else listing_page(int(pid)))
+
+        server.count('not_found')
+        self._send(404, b'<html><body>Page not found</body></html>')
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    '''
+    The stand-in server. counts has the number of requests of each kind so far.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, port=0, listings=LISTINGS_PER_SEARCH, interval=INTERVAL,
+                 latency=LATENCY, jitter=JITTER, error_rate=ERROR_RATE,
+                 throttle_rate=THROTTLE_RATE, burst=BURST, pages_dir=None,
+                 result_cap=shards.RESULT_CAP):
+
+        HTTPServer.__init__(self, ('127.0.0.1', port), ReplayHandler)
+        self.num_listings = listings
+        self.interval = interval
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.burst = burst
+        self.result_cap = result_cap
+        self.start = dt.now().replace(second=0, microsecond=0)
+        self.counts = {}
+        self._searches = {}
+        self._tokens = burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+        self.cache = None
+        self._pids = None
+        if pages_dir is not None:
+            # Replay cached listing pages, whatever their age
+            self.cache = pagecache.PageCache(pages_dir, ttl=float('inf'))
+            self._pids = sorted((int(os.path.basename(f)[:-2]) for f in
+                                 glob.glob(os.path.join(pages_dir, '*', '*.z'))), reverse=True)
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+
+    def count(self, kind):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+
+
+    def listings(self, region, category):
+
+        key = (region, category)
+        with self._lock:
+            if key not in self._searches:
+                self._searches[key] = Listings(region, category, self.num_listings,
+                                               self.interval, self.start, self._pids)
+            return self._searches[key]
+
+
+    def throttled(self):
+        '''
+        Token bucket over all requests, like a block by IP address.
+        '''
+        if self.throttle_rate is None:
+            return False
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.throttle_rate)
+            self._last = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+
+def start(**kwargs):
+    '''
+    Starts a ReplayServer in a background thread and returns it. Stop it with
+    server.shutdown().
+    '''
+    server = ReplayServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Local stand-in for Craigslist, used as an HTTP proxy.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--listings', type=int, default=LISTINGS_PER_SEARCH, help='listings per search')
+    parser.add_argument('--interval', type=float, default=INTERVAL, help='seconds between listings')
+    parser.add_argument('--latency', type=float, default=LATENCY, help='seconds added to each response')
+    parser.add_argument('--jitter', type=float, default=JITTER, help='up to this many more seconds')
+    parser.add_argument('--error-rate', type=float, default=ERROR_RATE, help='fraction of 503 responses')
+    parser.add_argument('--throttle-rate', type=float, default=THROTTLE_RATE,
+                        help='requests per second before blocking')
+    parser.add_argument('--pages', default=None, help='page cache directory to replay')
+    args = parser.parse_args()
+
+    server = ReplayServer(port=args.port, listings=args.listings, interval=args.interval,
+                          latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                          throttle_rate=args.throttle_rate, pages_dir=args.pages)
+    print('Serving Craigslist on {0}, use it as HTTP_PROXY'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -9,6 +9,7 @@ import sys
 sys.path.insert(0, 'scraper2/')
 
 import scraper2
+import seenpids
 
 
 with open('domains.txt', 'rb') as f:
@@ -17,11 +18,17 @@ with open('domains.txt', 'rb') as f:
 yesterday24h = dt.combine(date.today(), time.min)
 yesterday00h = yesterday24h - timedelta(days=1)
 
+# Skip listings that the hourly runs have already stored
+seen_fname = 'logs/seen_pids.npy'
+seenpids.build_index(seen_fname, scraper2.DB_CONN_STR, scraper2.DB_TABLE)
+
 s = scraper2.RentalListingScraper(
 		domains = domains,
 		fname_base = yesterday00h.strftime('%Y%m%d'),
 		earliest_ts = yesterday00h,
 		latest_ts = yesterday24h,
-		fname_ts = False)
+		fname_ts = False,
+		seen_pids = seen_fname,
+		resume = True)  # pick up where an interrupted run for the same day stopped
 
 s.run()
\ No newline at end of file
@@ -0,0 +1,226 @@
+import re
+import cleaning
+import resultparser
+import sinks
+
+try:
+    from urllib import unquote_plus
+except ImportError:
+    from urllib.parse import unquote_plus
+
+# Category crawled when a domain doesn't name one
+DEFAULT_CATEGORY = 'apa'
+
+# Shared room rows are only saved to the data files unless this is True. They're then
+# also cleaned and loaded into the shared_listings table, without census blocks, as the
+# old shared room scraper was meant to once its cleaning was finished
+LOAD_SHARED_ROOMS = False
+
+
+def search_url(domain, category):
+    '''
+    Returns the search url for category in the same region, and sub-area or price band
+    if domain has one. domain can be a search url for another category, or just the
+    region's host, like http://sfbay.craigslist.org.
+    '''
+    if '/search/' not in domain:
+        return domain.rstrip('/') + '/search/' + category
+    return re.sub(r'/search/((?:[^/?]+/)?)[^/?]+', r'/search/\g<1>' + category, domain, count=1)
+
+
+def domain_category(domain):
+    '''
+    Returns the category that domain searches, or DEFAULT_CATEGORY if it's just a host.
+    '''
+    match = re.search(r'/search/(?:[^/?]+/)?([^/?]+)', domain)
+    return match.group(1) if match else DEFAULT_CATEGORY
+
+
+class ApartmentCategory(object):
+    '''
+    Apartments and houses for rent. Rows are cleaned, geocoded and loaded into the
+    rental_listings table, or the scraper's DB_TABLE.
+    '''
+
+    colnames = ['pid', 'dt', 'url', 'title', 'price', 'neighb', 'beds', 'sqft', 'baths',
+                'lat', 'lng', 'accuracy', 'address']
+    schema = sinks.APA_SCHEMA
+    load = True
+    geocode = True
+    prefetch_filter = True  # the filter's rules are about what clean() drops
+    table = None  # the scraper's DB_TABLE and DB_COLUMNS
+    db_columns = None
+
+    def __init__(self, code='apa'):
+        self.code = code
+
+
+    def read(self, filename):
+        return cleaning.read_listings(filename)
+
+
+    def clean(self, listings):
+        return cleaning.clean_listings(listings)
+
+
+    def parse_row(self, item):
+        '''
+        Returns [pid, dt, url, title, price, neighb, beds, sqft] for a row of search
+        results. See resultparser.parse_result_row().
+        '''
+        return resultparser.parse_result_row(item)
+
+
+    def _address(self, tree):
+        '''
+        Some listings include an address, but we have to parse it out of an encoded
+        Google Maps url.
+        '''
+        url = tree.xpath('//p[@class="mapaddress"]/small/a/@href')
+        url = url[0] if len(url) > 0 else ''
+
+        if '?q=loc' not in url:
+            # That string precedes an address search
+            return ''
+
+        return unquote_plus(url.split('?q=loc')[1]).strip(' :')
+
+
+    def parse_details(self, tree):
+        '''
+        Returns [baths, lat, lng, accuracy, address] from a listing page.
+        '''
+        try:
+            baths = tree.xpath('//div[@class="mapAndAttrs"]/p[@class="attrgroup"]/span/b')[1].text[:-2]
+        except:
+            baths = ''
+        map = tree.xpath('//div[@id="map"]')
+
+        # Sometimes there's no location info, and no map on the page
+        if len(map) == 0:
+            return [baths, '', '', '', '']
+
+        map = map[0]
+        lat = map.xpath('@data-latitude')[0]
+        lng = map.xpath('@data-longitude')[0]
+        accuracy = map.xpath('@data-accuracy')[0]
+        address = self._address(tree)
+
+        return [baths, lat, lng, accuracy, address]
+
+
+class SharedRoomCategory(object):
+    '''
+    Rooms and shares. Rows also get the listing's body text and amenities. They are
+    only saved to the data files, unless LOAD_SHARED_ROOMS is on.
+    '''
+
+    colnames = ['pid', 'dt', 'url', 'title', 'price', 'neighb', 'sqft', 'lat', 'lng',
+                'accuracy', 'body_text', 'furnished', 'laundry_known', 'laundry_onpremises',
+                'laundry_inunit', 'room_known', 'private_room', 'bath_known', 'private_bath',
+                'parking_known', 'onsite_parking']
+    schema = sinks.ROO_SCHEMA
+    geocode = False
+    prefetch_filter = False
+    table = 'shared_listings'
+    db_columns = cleaning.SHARED_OUTPUT_COLUMNS
+
+    def __init__(self, code='roo'):
+        self.code = code
+
+
+    @property
+    def load(self):
+        return LOAD_SHARED_ROOMS
+
+
+    def read(self, filename):
+        return cleaning.read_listings(filename, cleaning.SHARED_TEXT)
+
+
+    def clean(self, listings):
+        return cleaning.clean_shared_listings(listings)
+
+
+    def parse_row(self, item):
+        '''
+        Returns [pid, dt, url, title, price, neighb, sqft], leaving out the bedrooms
+        field, which doesn't apply to shared rooms.
+        '''
+        row = resultparser.parse_result_row(item)
+        return row[:6] + row[7:]
+
+
+    def _location(self, tree):
+
+        map = tree.xpath('//div[@id="map"]')
+
+        # Sometimes there's no location info, and no map on the page
+        if len(map) == 0:
+            return [99, 99, 99]
+
+        map = map[0]
+        return [map.xpath('@data-latitude')[0], map.xpath('@data-longitude')[0],
+                map.xpath('@data-accuracy')[0]]
+
+
+    def _body_text(self, tree):
+        # The whole text of the post, stripped of its markup
+        path = tree.xpath('//section[@id="postingbody"]')[0]
+        return [''.join(path.xpath('text()')).strip().encode('utf-8')]
+
+
+    def _attributes(self, tree):
+        '''
+        Parses the amenities, which the listing gives as a list of short phrases.
+        '''
+        attrs = [attr.text for attr in
+                 tree.xpath('/html/body/section/section/section/div[1]/p[2]/span')]
+        has = lambda phrase: any([phrase in text for text in attrs])
+        flag = lambda value: 'TRUE' if value else 'FALSE'
+
+        furnished = has('furnished')  # A False doesn't necessarily mean the unit isn't furnished
+
+        laundry_known = has('laundry') or has('w/d')
+        no_laundryonsite = has('no laundry') or has('hookups')
+        laundry_inunit = has('w/d in unit')
+        laundry_onpremises = laundry_known and not no_laundryonsite and not laundry_inunit
+
+        room_known = has('room')
+        private_room = room_known and has('private room')
+
+        bath_known = has('bath')
+        private_bath = has('private bath') and not has('no private bath')
+
+        parking_possible = any([has(p) for p in ['carport', 'attached garage', 'off-street parking',
+                                                 'detached garage', 'valet parking']])
+        parking_known = parking_possible or has('street parking') or has('no parking')
+        no_onsiteparking = has('no parking') or has('street parking')
+        parking_onsite = parking_possible and not no_onsiteparking
+
+        return [furnished, flag(laundry_known), flag(laundry_onpremises), laundry_inunit,
+                room_known, flag(private_room), bath_known, flag(private_bath),
+                flag(parking_known), flag(parking_onsite)]
+
+
+    def parse_details(self, tree):
+        '''
+        Returns the location, body text and amenity fields from a listing page.
+        '''
+        return self._location(tree) + self._body_text(tree) + self._attributes(tree)
+
+
+# Categories that can be crawled, by their code in search urls. The apa and aap
+# searches return the same kind of listing.
+CATEGORIES = {
+    'apa': ApartmentCategory('apa'),
+    'aap': ApartmentCategory('aap'),
+    'roo': SharedRoomCategory('roo')}
+
+
+def get_category(code):
+
+    if code not in CATEGORIES:
+        raise ValueError('Unknown category {0}, use one of {1}'.format(
+            code, ', '.join(sorted(CATEGORIES))))
+    return CATEGORIES[code]
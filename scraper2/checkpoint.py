@@ -0,0 +1,58 @@
+import json
+import logging
+import os
+import re
+import time
+
+
+class Checkpoints(object):
+    '''
+    Saves how far the crawl of each domain has got, in one small JSON file per domain,
+    so that an interrupted run can continue where it stopped. A checkpoint belongs to
+    one run, identified by run_id, and is ignored by runs with a different id.
+    '''
+
+    def __init__(self, path):
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+
+
+    def _fname(self, domain):
+        return os.path.join(self.path, re.sub(r'[^A-Za-z0-9.-]+', '_', domain) + '.json')
+
+
+    def load(self, domain, run_id):
+        '''
+        Returns the saved state for domain, or None if there isn't one for this run.
+        '''
+        fname = self._fname(domain)
+        if not os.path.exists(fname):
+            return None
+
+        try:
+            with open(fname) as f:
+                state = json.load(f)
+        except ValueError:
+            logging.warning('Could not read checkpoint {0}'.format(fname))
+            return None
+
+        if state.get('run_id') != run_id:
+            return None
+        return state
+
+
+    def save(self, domain, run_id, state):
+        '''
+        Replaces the checkpoint for domain. The file is written under a temporary name
+        first, so a crash never leaves half a checkpoint behind.
+        '''
+        state = dict(state, run_id=run_id, saved=time.time())
+        fname = self._fname(domain)
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_fname, fname)
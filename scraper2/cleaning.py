@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import sinks
+
+# Columns of scraped rows that hold numbers, and the text columns that are needed for
+# cleaning. read_listings() skips the others.
+NUMERIC = ['price', 'beds', 'baths', 'sqft', 'lng', 'lat']
+TEXT = ['pid', 'dt', 'url', 'neighb']
+
+RENAME = {'price': 'rent', 'dt': 'date', 'beds': 'bedrooms', 'neighb': 'neighborhood',
+          'baths': 'bathrooms', 'lng': 'longitude', 'lat': 'latitude'}
+
+OUTPUT_COLUMNS = ['pid', 'date', 'region', 'neighborhood', 'rent', 'bedrooms', 'sqft',
+                  'rent_sqft', 'bathrooms', 'longitude', 'latitude']
+
+REGION = 'http://(.*).craigslist.org'
+
+# Shared room rows keep their text and amenity columns, which go to the database as
+# they were scraped. See categories.py.
+SHARED_TEXT = TEXT + ['title', 'accuracy', 'body_text', 'furnished', 'laundry_known',
+                      'laundry_onpremises', 'laundry_inunit', 'room_known', 'private_room',
+                      'bath_known', 'private_bath', 'parking_known', 'onsite_parking']
+
+SHARED_OUTPUT_COLUMNS = ['pid', 'date', 'day_of_week', 'url', 'title', 'rent', 'rent_sqft',
+                         'neighborhood', 'region', 'sqft', 'latitude', 'longitude', 'accuracy',
+                         'body_text', 'furnished', 'laundry_known', 'laundry_onpremises',
+                         'laundry_inunit', 'room_known', 'private_room', 'bath_known',
+                         'private_bath', 'parking_known', 'onsite_parking']
+
+
+def _to_float(listings):
+    '''
+    Makes sure the numeric columns are floats. Values that read_csv() couldn't parse as
+    numbers, or that weren't parsed yet, are converted with NaN for anything that isn't
+    a number.
+    '''
+    for col in NUMERIC:
+        if col in listings and listings[col].dtype != np.float64:
+            listings[col] = pd.to_numeric(listings[col], errors='coerce').astype(np.float64)
+    return listings
+
+
+def read_listings(filename, text=TEXT):
+    '''
+    Reads the columns needed for cleaning from a CSV or Parquet file of scraped rows:
+    NUMERIC and the text columns, those of the file that are in text. Text columns are
+    strings, with missing values as empty strings, and numbers are parsed by read_csv()
+    itself, with empty values as NaN.
+    '''
+    if filename.endswith(sinks.FORMATS['parquet']):
+        listings = sinks.read_file(filename, columns=text + NUMERIC)
+        for col in text:
+            if col in listings and col != 'dt':
+                listings[col] = listings[col].astype(object).where(listings[col].notnull(), '')
+        listings['pid'] = listings['pid'].astype(str)
+        return _to_float(listings)
+
+    listings = pd.read_csv(filename, usecols=lambda col: col in text or col in NUMERIC,
+                           dtype=dict((col, str) for col in text), keep_default_na=False,
+                           na_values=dict((col, ['']) for col in NUMERIC),
+                           float_precision='high')
+    return _to_float(listings)
+
+
+def frame(rows, colnames):
+    '''
+    Makes a DataFrame from scraped rows, with the same types as read_listings().
+    '''
+    return _to_float(pd.DataFrame(rows, columns=colnames))
+
+
+def clean_listings(all_listings):
+    '''
+    Keeps the first row for each pid, and only listings with rent, sqft and a location.
+    Returns those listings with OUTPUT_COLUMNS, ready to be geocoded, along with the
+    numbers of rows before cleaning and with rent and sqft.
+    '''
+    listings = all_listings.rename(columns=RENAME)
+    thorough = ~listings.duplicated(subset='pid') & (listings['rent'] > 0) & (listings['sqft'] > 0)
+    located = thorough & listings['latitude'].notnull() & listings['longitude'].notnull()
+
+    # Derived columns are only computed for the rows we keep
+    output = listings.loc[located, ['pid', 'date', 'url', 'neighborhood', 'rent', 'bedrooms',
+                                    'sqft', 'bathrooms', 'longitude', 'latitude']]
+    output = output.assign(
+        rent_sqft=output['rent'] / output['sqft'],
+        date=pd.to_datetime(output['date'], format='%Y-%m-%d'),
+        region=output['url'].str.extract(REGION, expand=False))
+
+    return output[OUTPUT_COLUMNS], len(all_listings), int(thorough.sum())
+
+
+def clean_shared_listings(all_listings):
+    '''
+    Keeps the first row for each pid of shared room listings, which don't need rent,
+    sqft or a location. Returns them with SHARED_OUTPUT_COLUMNS, along with the numbers
+    of rows before and after. Missing numbers are None, so they're loaded as NULL.
+    '''
+    listings = all_listings.rename(columns=RENAME)
+    output = listings[~listings.duplicated(subset='pid')]
+    date = pd.to_datetime(output['date'], format='%Y-%m-%d')
+    output = output.assign(
+        rent_sqft=output['rent'] / output['sqft'].where(output['sqft'] > 0),
+        date=date,
+        day_of_week=date.dt.weekday,
+        region=output['url'].str.extract(REGION, expand=False))
+
+    numbers = ['rent', 'rent_sqft', 'sqft', 'latitude', 'longitude']
+    output[numbers] = output[numbers].astype(object).where(output[numbers].notnull(), None)
+    return output[SHARED_OUTPUT_COLUMNS], len(all_listings), len(output)
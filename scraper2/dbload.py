@@ -0,0 +1,83 @@
+import logging
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+# Rows per multi-row INSERT statement into the staging table
+BATCH_SIZE = 1000
+
+
+def _plain(value):
+    '''
+    psycopg2 doesn't know how to adapt numpy scalars, so convert them to the
+    equivalent Python values.
+    '''
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def insert_rows(conn, table, rows, pids):
+    '''
+    Inserts rows one at a time, each in its own savepoint, and commits once at the end.
+    This is slower than bulk_insert() but tells us exactly which rows have problems.
+    Returns lists of problem, duplicate and written pids.
+    '''
+    cur = conn.cursor()
+    prob_PIDs = []
+    dupes = []
+    writes = []
+    sql = 'INSERT INTO {0} VALUES %s ON CONFLICT DO NOTHING RETURNING pid'.format(table)
+
+    for row, pid in zip(rows, pids):
+        try:
+            cur.execute('SAVEPOINT insert_row')
+            execute_values(cur, sql, [tuple(_plain(v) for v in row)])
+            if cur.fetchone() is None:
+                dupes.append(pid)
+            else:
+                writes.append(pid)
+            cur.execute('RELEASE SAVEPOINT insert_row')
+        except psycopg2.Error as e:
+            logging.warning('Could not insert {0} into {1}: {2}'.format(pid, table, e))
+            prob_PIDs.append(str(pid))
+            cur.execute('ROLLBACK TO SAVEPOINT insert_row')
+
+    conn.commit()
+    cur.close()
+    return prob_PIDs, dupes, writes
+
+
+def bulk_insert(conn, table, rows, pids):
+    '''
+    Loads rows into a temporary staging table with batched multi-row inserts, then
+    moves them into table in a single statement that skips pids that are already
+    there. Everything happens in one transaction, so running it again is harmless. If
+    any row is rejected, falls back to insert_rows() to find out which.
+
+    Rows are tuples in the table's column order. Returns lists of problem, duplicate
+    and written pids, like the per-row loaders did.
+    '''
+    if len(rows) == 0:
+        return [], [], []
+
+    staging = 'staging_' + table
+    cur = conn.cursor()
+    try:
+        cur.execute('CREATE TEMP TABLE {0} (LIKE {1}) ON COMMIT DROP'.format(staging, table))
+        execute_values(cur, 'INSERT INTO {0} VALUES %s'.format(staging),
+                       [tuple(_plain(v) for v in row) for row in rows], page_size=BATCH_SIZE)
+        cur.execute('INSERT INTO {0} SELECT * FROM {1} ON CONFLICT DO NOTHING RETURNING pid'.format(
+            table, staging))
+        written = set(str(r[0]) for r in cur.fetchall())
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logging.warning('Bulk insert into {0} failed, inserting row by row: {1}'.format(table, e))
+        return insert_rows(conn, table, rows, pids)
+    finally:
+        cur.close()
+
+    writes = [pid for pid in pids if str(pid) in written]
+    dupes = [pid for pid in pids if str(pid) not in written]
+    return [], dupes, writes
@@ -0,0 +1,104 @@
+import logging
+import os
+import sqlite3
+import pandas as pd
+
+# Craigslist snaps approximate locations to a handful of points, so many listings share
+# the same coordinates. Lookups are cached under coordinates rounded to this many
+# decimal places (about a meter), which keeps listings in different blocks apart.
+PRECISION = 5
+
+TIMEOUT = 30  # seconds to wait for another process that is writing to the cache
+
+COLUMNS = ['county', 'fips_block', 'state']
+
+
+class FipsCache(object):
+    '''
+    Persistent cache of census block lookups in a SQLite file, keyed by rounded
+    latitude and longitude. Several processes can share the same file.
+    '''
+
+    def __init__(self, fname, precision=PRECISION):
+
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(fname, timeout=TIMEOUT)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS fips ('
+                         'lat INTEGER, lng INTEGER, county TEXT, fips_block TEXT, state TEXT, '
+                         'PRIMARY KEY (lat, lng))')
+        self._db.commit()
+
+
+    def _key(self, lat, lng):
+        scale = 10 ** self.precision
+        return int(round(float(lat) * scale)), int(round(float(lng) * scale))
+
+
+    def get(self, lat, lng):
+        '''
+        Returns (county, fips_block, state) for a point, or None if it isn't cached.
+        '''
+        row = self._db.execute('SELECT county, fips_block, state FROM fips WHERE lat=? AND lng=?',
+                               self._key(lat, lng)).fetchone()
+        return tuple(row) if row is not None else None
+
+
+    def put_many(self, items):
+        '''
+        Stores a list of ((lat, lng), (county, fips_block, state)) pairs.
+        '''
+        rows = [self._key(lat, lng) + tuple(values) for (lat, lng), values in items]
+        try:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO fips VALUES (?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error as e:
+            # Not worth failing a run over, we'll look them up again next time
+            logging.warning('Could not update FIPS cache: {0}'.format(e))
+
+
+    def lookup(self, listings, geocode):
+        '''
+        Returns a DataFrame with county, fips_block and state for each row of listings,
+        which needs latitude and longitude columns. Points that aren't cached are passed
+        to geocode(), once per distinct location, and the results are saved unless the
+        lookup failed, so that it's tried again next time. Hits and misses are counted
+        per distinct location.
+        '''
+        keys = [self._key(lat, lng) for lat, lng in zip(listings['latitude'], listings['longitude'])]
+
+        found = {}
+        todo = []  # positions of the first listing at each uncached location
+        for i, key in enumerate(keys):
+            if key in found:
+                continue
+            values = self.get(listings['latitude'].iat[i], listings['longitude'].iat[i])
+            found[key] = values
+            if values is None:
+                todo.append(i)
+
+        self.misses += len(todo)
+        self.hits += len(found) - len(todo)
+
+        if len(todo) > 0:
+            new = geocode(listings.iloc[todo])[COLUMNS]
+            items = []
+            for i, values in zip(todo, new.itertuples(index=False)):
+                values = tuple(None if pd.isnull(v) else v for v in values)
+                found[keys[i]] = values
+                if values[COLUMNS.index('fips_block')] is None:
+                    continue
+                items.append(((listings['latitude'].iat[i], listings['longitude'].iat[i]), values))
+            self.put_many(items)
+
+        return pd.DataFrame([found[key] for key in keys], index=listings.index, columns=COLUMNS)
+
+
+    def close(self):
+        self._db.close()
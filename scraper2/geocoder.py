@@ -0,0 +1,232 @@
+from __future__ import division
+from __future__ import print_function
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Offline replacement for the FCC block API. The index is built once from Census
+# TIGER/Line shapefiles (pyshp is needed for that step only):
+#
+#   python geocoder.py <index_dir> <county.shp> <tabblock.shp> [<tabblock.shp> ...]
+#
+# using for example tl_2016_us_county.shp and the tl_2016_XX_tabblock10.shp files for
+# the states we scrape. The index is a directory of .npy arrays, which scrapers
+# memory-map so that all worker processes share one copy.
+
+CELL_SIZE = 0.01  # degrees per grid cell in the spatial index
+
+STATE_CODES = {
+    '01': 'AL', '02': 'AK', '04': 'AZ', '05': 'AR', '06': 'CA', '08': 'CO', '09': 'CT',
+    '10': 'DE', '11': 'DC', '12': 'FL', '13': 'GA', '15': 'HI', '16': 'ID', '17': 'IL',
+    '18': 'IN', '19': 'IA', '20': 'KS', '21': 'KY', '22': 'LA', '23': 'ME', '24': 'MD',
+    '25': 'MA', '26': 'MI', '27': 'MN', '28': 'MS', '29': 'MO', '30': 'MT', '31': 'NE',
+    '32': 'NV', '33': 'NH', '34': 'NJ', '35': 'NM', '36': 'NY', '37': 'NC', '38': 'ND',
+    '39': 'OH', '40': 'OK', '41': 'OR', '42': 'PA', '44': 'RI', '45': 'SC', '46': 'SD',
+    '47': 'TN', '48': 'TX', '49': 'UT', '50': 'VT', '51': 'VA', '53': 'WA', '54': 'WV',
+    '55': 'WI', '56': 'WY', '60': 'AS', '66': 'GU', '69': 'MP', '72': 'PR', '78': 'VI'}
+
+ARRAYS = ['xs', 'ys', 'edge_ok', 'vertex_start', 'bbox', 'geoid', 'cell_keys',
+          'cell_start', 'cell_polys']
+
+
+def _cell_keys(lons, lats, cell_size):
+    ix = np.floor((np.asarray(lons) + 180) / cell_size).astype(np.int64)
+    iy = np.floor((np.asarray(lats) + 90) / cell_size).astype(np.int64)
+    return ix * 1000000 + iy
+
+
+def _field(fields, record, names):
+    for name in names:
+        if name in fields:
+            return record[fields.index(name)]
+    raise KeyError('None of the fields {0} found'.format(', '.join(names)))
+
+
+def build_index(index_dir, county_shapefile, block_shapefiles, cell_size=CELL_SIZE):
+    '''
+    Reads census block polygons and county names from TIGER/Line shapefiles and saves
+    a gridded spatial index of them to index_dir. Returns the number of blocks.
+    '''
+    import shapefile  # pyshp
+
+    counties = {}
+    sf = shapefile.Reader(county_shapefile)
+    fields = [f[0] for f in sf.fields[1:]]
+    for record in sf.iterRecords():
+        code = _field(fields, record, ['STATEFP', 'STATEFP10']) + \
+            _field(fields, record, ['COUNTYFP', 'COUNTYFP10'])
+        counties[code] = _field(fields, record, ['NAME', 'NAME10'])
+
+    xs, ys, edge_ok, vertex_start, bbox, geoid = [], [], [], [0], [], []
+    num_vertices = 0
+
+    for fname in block_shapefiles:
+        sf = shapefile.Reader(fname)
+        fields = [f[0] for f in sf.fields[1:]]
+        for shape_record in sf.iterShapeRecords():
+            shape = shape_record.shape
+            if len(shape.points) == 0:
+                continue
+            points = np.asarray(shape.points, dtype=np.float64)
+
+            # An edge joins each vertex to the next one, except at the end of a ring
+            ok = np.ones(len(points), dtype=bool)
+            ring_ends = list(shape.parts[1:]) + [len(points)]
+            ok[np.asarray(ring_ends) - 1] = False
+
+            xs.append(points[:, 0])
+            ys.append(points[:, 1])
+            edge_ok.append(ok)
+            num_vertices += len(points)
+            vertex_start.append(num_vertices)
+            bbox.append(shape.bbox)
+            geoid.append(_field(fields, shape_record.record, ['GEOID10', 'GEOID20', 'GEOID']))
+
+    bbox = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)  # min lon, min lat, max lon, max lat
+
+    # Register each block in every grid cell that its bounding box touches
+    lo = _cell_keys(bbox[:, 0], bbox[:, 1], cell_size)
+    hi = _cell_keys(bbox[:, 2], bbox[:, 3], cell_size)
+    keys, polys = [], []
+    for i in range(len(bbox)):
+        ix = np.arange(lo[i] // 1000000, hi[i] // 1000000 + 1)
+        iy = np.arange(lo[i] % 1000000, hi[i] % 1000000 + 1)
+        cells = (ix[:, None] * 1000000 + iy[None, :]).ravel()
+        keys.append(cells)
+        polys.append(np.full(len(cells), i, dtype=np.int64))
+
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    polys = np.concatenate(polys) if polys else np.zeros(0, dtype=np.int64)
+    order = np.argsort(keys, kind='mergesort')
+    keys, polys = keys[order], polys[order]
+    cell_keys, cell_start = np.unique(keys, return_index=True)
+    cell_start = np.append(cell_start, len(keys))
+
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+
+    arrays = {
+        'xs': np.concatenate(xs) if xs else np.zeros(0),
+        'ys': np.concatenate(ys) if ys else np.zeros(0),
+        'edge_ok': np.concatenate(edge_ok) if edge_ok else np.zeros(0, dtype=bool),
+        'vertex_start': np.asarray(vertex_start, dtype=np.int64),
+        'bbox': bbox,
+        'geoid': np.asarray(geoid, dtype='S15'),
+        'cell_keys': cell_keys,
+        'cell_start': cell_start.astype(np.int64),
+        'cell_polys': polys}
+    for name in ARRAYS:
+        np.save(os.path.join(index_dir, name + '.npy'), arrays[name])
+
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump({'cell_size': cell_size, 'counties': counties}, f)
+
+    return len(geoid)
+
+
+class BlockGeocoder(object):
+    '''
+    Looks up census blocks for batches of points, using an index made by build_index().
+    Candidate blocks come from the grid cell of each point, and are then checked with
+    a vectorized point-in-polygon test.
+    '''
+
+    def __init__(self, index_dir):
+
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r'))
+
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.cell_size = meta['cell_size']
+        self.counties = meta['counties']
+
+
+    def _contains(self, i, px, py):
+        '''
+        Even-odd test of whether each point is inside block i. Holes are handled by
+        the even-odd rule.
+        '''
+        v0, v1 = self.vertex_start[i], self.vertex_start[i + 1]
+        idx = np.arange(v0, v1 - 1)
+        idx = idx[self.edge_ok[v0:v1 - 1]]
+        x1, y1 = self.xs[idx], self.ys[idx]
+        x2, y2 = self.xs[idx + 1], self.ys[idx + 1]
+
+        px = px[:, None]
+        py = py[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crosses = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+        return crosses.sum(axis=1) % 2 == 1
+
+
+    def lookup_blocks(self, lats, lons):
+        '''
+        Returns an array with the index of the block containing each point, or -1.
+        '''
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.full(len(lats), -1, dtype=np.int64)
+
+        valid = np.isfinite(lats) & np.isfinite(lons)
+        keys = _cell_keys(np.where(valid, lons, 0), np.where(valid, lats, 0), self.cell_size)
+        pos = np.searchsorted(self.cell_keys, keys)
+        pos = np.minimum(pos, max(len(self.cell_keys) - 1, 0))
+        found = valid & (len(self.cell_keys) > 0)
+        if len(self.cell_keys) > 0:
+            found &= self.cell_keys[pos] == keys
+
+        cells, inverse = np.unique(pos[found], return_inverse=True)
+        point_idx = np.nonzero(found)[0]
+
+        for c, cell in enumerate(cells):
+            todo = point_idx[inverse == c]
+            for i in self.cell_polys[self.cell_start[cell]:self.cell_start[cell + 1]]:
+                px, py = lons[todo], lats[todo]
+                b = self.bbox[i]
+                near = (px >= b[0]) & (px <= b[2]) & (py >= b[1]) & (py <= b[3])
+                if not near.any():
+                    continue
+                inside = np.zeros(len(todo), dtype=bool)
+                inside[near] = self._contains(i, px[near], py[near])
+                result[todo[inside]] = i
+                todo = todo[~inside]
+                if len(todo) == 0:
+                    break
+
+        return result
+
+
+    def lookup(self, lats, lons, index=None):
+        '''
+        Returns a DataFrame with the same fips_block, state and county columns as the
+        FCC API, with None for points that aren't in any block.
+        '''
+        blocks = self.lookup_blocks(lats, lons)
+        fips, states, counties = [], [], []
+        for i in blocks:
+            if i < 0:
+                fips.append(None)
+                states.append(None)
+                counties.append(None)
+                continue
+            geoid = self.geoid[i]
+            geoid = geoid.decode('ascii') if isinstance(geoid, bytes) else str(geoid)
+            fips.append(geoid)
+            states.append(STATE_CODES.get(geoid[:2]))
+            counties.append(self.counties.get(geoid[:5]))
+
+        return pd.DataFrame({'fips_block': fips, 'state': states, 'county': counties},
+                            index=index, columns=['county', 'fips_block', 'state'])
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 4:
+        print('Usage: python geocoder.py <index_dir> <county.shp> <tabblock.shp> [...]')
+        sys.exit(1)
+
+    n = build_index(sys.argv[1], sys.argv[2], sys.argv[3:])
+    print('Indexed {0} blocks in {1}'.format(n, sys.argv[1]))
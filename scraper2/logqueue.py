@@ -0,0 +1,177 @@
+import json
+import logging
+import multiprocessing
+import threading
+import time
+
+# Only one in LISTING_SAMPLE per-listing lines (the url of every listing page fetched)
+# is kept in structured logs. Kept lines have a sampled field with this number, to
+# weight them by when counting.
+LISTING_SAMPLE = 100
+
+# Pass as extra to mark a log call as a per-listing line, for example
+# logging.info(url, extra=logqueue.LISTING)
+LISTING = {'listing': True}
+
+
+def event(name, **fields):
+    '''
+    Returns the extra for a log call that is a structured event, like a region summary.
+    In the JSON format the fields become keys of the line, next to the message.
+    '''
+    return {'event': name, 'fields': fields}
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats records as one JSON object per line.
+    '''
+
+    def format(self, record):
+
+        line = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+                'level': record.levelname, 'logger': record.name, 'process': record.process,
+                'msg': record.getMessage()}
+        if getattr(record, 'event', None) is not None:
+            line['event'] = record.event
+            line.update(getattr(record, 'fields', {}))
+        if getattr(record, 'sampled', None) is not None:
+            line['sampled'] = record.sampled
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line['exc'] = record.exc_text
+        return json.dumps(line, sort_keys=True, default=str)
+
+
+class ListingSampler(logging.Filter):
+    '''
+    Drops all but one in every sample per-listing lines, and passes everything else.
+    '''
+
+    def __init__(self, sample=LISTING_SAMPLE):
+
+        logging.Filter.__init__(self)
+        self.sample = sample
+        self._seen = 0
+        self._lock = threading.Lock()
+
+
+    def filter(self, record):
+
+        if not getattr(record, 'listing', False):
+            return True
+        with self._lock:
+            self._seen += 1
+            keep = self._seen % self.sample == 1 or self.sample == 1
+        if keep:
+            record.sampled = self.sample
+        return keep
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Sends records to a multiprocessing queue, for a QueueListener in another process to
+    write. Records are reduced to what can be pickled, with the message already
+    formatted.
+    '''
+
+    def __init__(self, queue):
+
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+
+    def emit(self, record):
+
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    '''
+    Writes the records from a queue with handler, so that a single process owns the log
+    file. It runs in a process of its own rather than a thread, so that the scheduler
+    has no threads that could hold a lock while its pool forks new workers.
+    '''
+
+    def __init__(self, queue, handler):
+
+        self.queue = queue
+        self.handler = handler
+        self._process = None
+
+
+    def start(self):
+
+        self._process = multiprocessing.Process(target=self._run)
+        self._process.daemon = True
+        self._process.start()
+
+
+    def _run(self):
+
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+        self.handler.close()
+
+
+    def stop(self):
+        '''
+        Writes the records still in the queue, then stops.
+        '''
+        self.queue.put(None)
+        self._process.join()
+        self.handler.close()
+
+
+def json_file_handler(fname):
+
+    handler = logging.FileHandler(fname)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def log_to_file(fname, structured=False):
+    '''
+    Sets up logging for a scraper, to fname as plain text or, if structured, as JSON
+    lines with per-listing lines sampled. Does nothing if logging is already set up in
+    this process, for example by init_worker().
+    '''
+    root = logging.getLogger()
+    if len(root.handlers) > 0:
+        return
+
+    if not structured:
+        logging.basicConfig(filename=fname, level=logging.INFO)
+        return
+
+    handler = json_file_handler(fname)
+    handler.addFilter(ListingSampler())
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+def init_worker(queue):
+    '''
+    Sends the log records of a worker process to queue, sampling per-listing lines
+    before they're sent. Used as the initializer of the scheduler's process pool.
+    '''
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    handler = QueueHandler(queue)
+    handler.addFilter(ListingSampler())
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
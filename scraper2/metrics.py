@@ -0,0 +1,200 @@
+from __future__ import division
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets, from a cached page read
+# to a slow database write. Times above the last one only go in the +Inf bucket.
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Names of the exported series in the Prometheus text format
+PROM_PREFIX = 'scraper'
+
+
+class Metrics(object):
+    '''
+    Counters and latency histograms for the stages of a crawl, kept per region. Safe to
+    update from the listing page threads. region is the label given to new values, and
+    is set by the scraper as it moves from one domain to the next.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+
+        self.buckets = list(buckets)
+        self.region = ''
+        self.counters = {}  # {(name, region): count}
+        self.histograms = {}  # {(stage, region): [bucket counts, +Inf count, sum]}
+        self._lock = threading.Lock()
+
+
+    def count(self, name, n=1, region=None):
+
+        key = (name, self.region if region is None else region)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+
+    def observe(self, stage, seconds, region=None):
+
+        key = (stage, self.region if region is None else region)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[0][i] += 1
+                    break
+            else:
+                hist[1] += 1
+            hist[2] += seconds
+
+
+    @contextmanager
+    def time(self, stage):
+        '''
+        Times the body of a with block as one observation of stage, even if it raises.
+        '''
+        st = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - st)
+
+
+    def snapshot(self, region=None):
+        '''
+        Returns the values as a plain dict that can be saved as JSON or passed between
+        processes, for one region or for all of them.
+        '''
+        with self._lock:
+            return {
+                'buckets': self.buckets,
+                'counters': [[name, r, n] for (name, r), n in sorted(self.counters.items())
+                             if region is None or r == region],
+                'histograms': [[stage, r, list(h[0]), h[1], h[2]]
+                               for (stage, r), h in sorted(self.histograms.items())
+                               if region is None or r == region]}
+
+
+    def merge(self, snapshot):
+        '''
+        Adds the values from a snapshot, for example one taken in a worker process.
+        '''
+        if snapshot['buckets'] != self.buckets:
+            raise ValueError('Histogram buckets do not match')
+        with self._lock:
+            for name, region, n in snapshot['counters']:
+                self.counters[(name, region)] = self.counters.get((name, region), 0) + n
+            for stage, region, counts, inf, total in snapshot['histograms']:
+                hist = self.histograms.setdefault((stage, region), [[0] * len(self.buckets), 0, 0.0])
+                hist[0] = [a + b for a, b in zip(hist[0], counts)]
+                hist[1] += inf
+                hist[2] += total
+
+
+    def _totals(self):
+        '''
+        Returns the counters and histograms with the regions added up, keyed by name.
+        '''
+        counters = {}
+        for (name, region), n in self.counters.items():
+            counters[name] = counters.get(name, 0) + n
+        histograms = {}
+        for (stage, region), (counts, inf, total) in self.histograms.items():
+            hist = histograms.setdefault(stage, [[0] * len(self.buckets), 0, 0.0])
+            hist[0] = [a + b for a, b in zip(hist[0], counts)]
+            hist[1] += inf
+            hist[2] += total
+        return counters, histograms
+
+
+    def _quantile(self, counts, inf, q):
+        '''
+        Upper bound of the bucket holding quantile q, or None if it's in the +Inf bucket.
+        '''
+        target = q * (sum(counts) + inf)
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return None
+
+
+    def to_prometheus(self):
+        '''
+        Returns the values in the Prometheus text format, per region and, without a
+        region label, for all regions together.
+        '''
+        counters, histograms = self._totals()
+        series = [(k, {'region': r}, v) for (k, r), v in self.counters.items()] + \
+                 [(k, {}, v) for k, v in counters.items()]
+        hists = [(k, {'region': r}, v) for (k, r), v in self.histograms.items()] + \
+                [(k, {}, v) for k, v in histograms.items()]
+
+        def labels(d):
+            return '{' + ','.join('{0}="{1}"'.format(k, v) for k, v in sorted(d.items())) + '}'
+
+        lines = ['# HELP {0}_events_total Things counted during the crawl.'.format(PROM_PREFIX),
+                 '# TYPE {0}_events_total counter'.format(PROM_PREFIX)]
+        for name, extra, n in sorted(series, key=lambda s: (s[0], sorted(s[1].items()))):
+            lines.append('{0}_events_total{1} {2}'.format(
+                PROM_PREFIX, labels(dict(extra, event=name)), n))
+
+        lines += ['# HELP {0}_stage_seconds Time spent in each stage of the crawl.'.format(PROM_PREFIX),
+                  '# TYPE {0}_stage_seconds histogram'.format(PROM_PREFIX)]
+        for stage, extra, (counts, inf, total) in sorted(hists, key=lambda s: (s[0], sorted(s[1].items()))):
+            extra = dict(extra, stage=stage)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('{0}_stage_seconds_bucket{1} {2}'.format(
+                    PROM_PREFIX, labels(dict(extra, le=repr(float(bound)))), cumulative))
+            cumulative += inf
+            lines.append('{0}_stage_seconds_bucket{1} {2}'.format(
+                PROM_PREFIX, labels(dict(extra, le='+Inf')), cumulative))
+            lines.append('{0}_stage_seconds_sum{1} {2!r}'.format(PROM_PREFIX, labels(extra), total))
+            lines.append('{0}_stage_seconds_count{1} {2}'.format(PROM_PREFIX, labels(extra), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def to_json_lines(self):
+        '''
+        Returns a summary with one JSON object per line: a line for each counter and
+        stage in each region, then for all regions together, with region 'all'.
+        '''
+        counters, histograms = self._totals()
+        now = time.time()
+        lines = []
+
+        for (name, region), n in sorted(self.counters.items()) + sorted(
+                ((name, 'all'), n) for name, n in counters.items()):
+            lines.append({'time': now, 'type': 'counter', 'name': name, 'region': region, 'value': n})
+
+        for (stage, region), (counts, inf, total) in sorted(self.histograms.items()) + sorted(
+                ((stage, 'all'), h) for stage, h in histograms.items()):
+            n = sum(counts) + inf
+            lines.append({'time': now, 'type': 'histogram', 'name': stage, 'region': region,
+                          'count': n, 'seconds': total, 'mean': total / n if n else None,
+                          'p50': self._quantile(counts, inf, 0.5),
+                          'p90': self._quantile(counts, inf, 0.9),
+                          'p99': self._quantile(counts, inf, 0.99)})
+
+        return ''.join(json.dumps(line, sort_keys=True) + '\n' for line in lines)
+
+
+    def write(self, fname):
+        '''
+        Saves the values to fname, in the Prometheus text format if it ends in .prom
+        and as JSON lines otherwise. The file is replaced in one step, so a collector
+        never reads half of it.
+        '''
+        text = self.to_prometheus() if fname.endswith('.prom') else self.to_json_lines()
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            f.write(text)
+        os.rename(tmp_fname, fname)
@@ -0,0 +1,172 @@
+from __future__ import division
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+import zlib
+import ratelimit
+
+# Cached listing pages are reused for TTL seconds, and the least recently used ones
+# are removed once the cache grows past MAX_BYTES
+TTL = 24 * 3600
+MAX_BYTES = 2 * 1024 ** 3
+
+# How many new pages a process writes between checks of the cache size
+EVICT_EVERY = 500
+
+
+class PageCache(object):
+    '''
+    On-disk cache of listing pages, keyed by posting id and stored zlib-compressed,
+    one file per page. Files are written to a temporary name and renamed into place,
+    so several processes can share a cache directory without locking on every read
+    or write. Eviction takes a lock so that only one process does it at a time.
+    '''
+
+    def __init__(self, path, ttl=TTL, max_bytes=MAX_BYTES):
+
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+
+    def _fname(self, pid):
+        # Spread files over subdirectories so no single directory gets too big
+        return os.path.join(self.path, str(pid)[-2:], str(pid) + '.z')
+
+
+    def get(self, pid):
+        '''
+        Returns the cached page content for pid, or None if it isn't cached or has
+        expired.
+        '''
+        fname = self._fname(pid)
+        now = time.time()
+        try:
+            mtime = os.path.getmtime(fname)
+            if now - mtime > self.ttl:
+                self._count(hit=False)
+                return None
+            with open(fname, 'rb') as f:
+                content = zlib.decompress(f.read())
+            # Access time records recent use for eviction, mtime stays the fetch time
+            os.utime(fname, (now, mtime))
+        except (IOError, OSError, zlib.error):
+            self._count(hit=False)
+            return None
+
+        self._count(hit=True)
+        return content
+
+
+    def _count(self, hit):
+        # get() is called from the listing page threads
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+    def put(self, pid, content):
+
+        fname = self._fname(pid)
+        tmp_fname = '{0}.{1}.{2}.tmp'.format(fname, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with open(tmp_fname, 'wb') as f:
+            f.write(zlib.compress(content))
+        os.rename(tmp_fname, fname)
+
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+
+    def evict(self):
+        '''
+        Deletes expired pages, then the least recently used ones until the cache is
+        under 90% of max_bytes. Skips the work if another process is already doing it.
+        '''
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+
+            try:
+                now = time.time()
+                files = []
+                total = 0
+                for root, dirs, fnames in os.walk(self.path):
+                    for fname in fnames:
+                        if not fname.endswith('.z'):
+                            continue
+                        fname = os.path.join(root, fname)
+                        try:
+                            st = os.stat(fname)
+                            if now - st.st_mtime > self.ttl:
+                                os.remove(fname)
+                                continue
+                        except OSError:
+                            continue
+                        files.append((st.st_atime, st.st_size, fname))
+                        total += st.st_size
+
+                removed = 0
+                if total > self.max_bytes:
+                    files.sort()
+                    for atime, size, fname in files:
+                        if total <= 0.9 * self.max_bytes:
+                            break
+                        try:
+                            os.remove(fname)
+                        except OSError:
+                            pass
+                        total -= size
+                        removed += 1
+
+                if removed > 0:
+                    logging.info('Evicted {0} pages from cache at {1}'.format(removed, self.path))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def fetch(session, url, pid=None, cache=None, on_request=None, **kwargs):
+    '''
+    Returns the content of a listing page, from the cache when it's there and otherwise
+    from the network, calling on_request() first if it's given. Only normal pages are
+    cached, not error or block pages. Extra arguments are passed on to session.get().
+    '''
+    if cache is not None and pid:
+        content = cache.get(pid)
+        if content is not None:
+            return content
+
+    if on_request is not None:
+        on_request()
+    page = session.get(url, **kwargs)
+    if cache is not None and pid and page.status_code == 200 and not ratelimit.is_throttled(page):
+        cache.put(pid, page.content)
+
+    return page.content
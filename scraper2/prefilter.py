@@ -0,0 +1,80 @@
+import re
+
+# Rules a listing from the search results has to pass before we fetch its page. The
+# numeric rules fail when the value is missing, so {'min_price': 1} means "has a price".
+RULES = ['min_price', 'max_price', 'min_beds', 'max_beds', 'min_sqft', 'max_sqft',
+         'neighborhoods', 'exclude_neighborhoods', 'title_include', 'title_exclude']
+
+
+def _number(value):
+    '''
+    Search result fields arrive as strings like '1200', '' or 0. Returns a float, or
+    None if the value is missing.
+    '''
+    try:
+        value = float(str(value).strip().replace(',', ''))
+    except (ValueError, UnicodeError):
+        return None
+    return value
+
+
+class ListingFilter(object):
+    '''
+    Decides from the fields on the search results page whether a listing's page is
+    worth fetching. Rules are passed as a dict, for example:
+
+        ListingFilter({'min_price': 1, 'min_sqft': 1, 'title_exclude': ['parking spot']})
+
+    Neighborhood and title rules are lists of case-insensitive substrings.
+    '''
+
+    def __init__(self, rules=None):
+
+        rules = dict(rules or {})
+        unknown = set(rules) - set(RULES)
+        if unknown:
+            raise ValueError('Unknown filter rules: {0}'.format(', '.join(sorted(unknown))))
+
+        self.rules = rules
+        self._patterns = {}
+        for key in ['neighborhoods', 'exclude_neighborhoods', 'title_include', 'title_exclude']:
+            if rules.get(key):
+                self._patterns[key] = re.compile(
+                    '|'.join(re.escape(s) for s in rules[key]), re.IGNORECASE)
+
+
+    def __nonzero__(self):
+        return len(self.rules) > 0
+
+    __bool__ = __nonzero__
+
+
+    def reject(self, listing):
+        '''
+        Takes a dict of search result fields (price, beds, sqft, neighb, title) and
+        returns the name of the first rule it fails, or None if it passes.
+        '''
+        for field in ['price', 'beds', 'sqft']:
+            low = self.rules.get('min_' + field)
+            high = self.rules.get('max_' + field)
+            if low is None and high is None:
+                continue
+            value = _number(listing.get(field, ''))
+            if value is None:
+                return 'min_' + field if low is not None else 'max_' + field
+            if low is not None and value < low:
+                return 'min_' + field
+            if high is not None and value > high:
+                return 'max_' + field
+
+        neighb = listing.get('neighb', '') or ''
+        title = listing.get('title', '') or ''
+        checks = [('neighborhoods', neighb, False), ('exclude_neighborhoods', neighb, True),
+                  ('title_include', title, False), ('title_exclude', title, True)]
+
+        for key, text, exclude in checks:
+            pattern = self._patterns.get(key)
+            if pattern is not None and bool(pattern.search(text)) == exclude:
+                return key
+
+        return None
@@ -0,0 +1,193 @@
+from __future__ import print_function
+import cProfile
+import glob
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 3 only, peak RSS is recorded instead
+
+# Seconds between samples of every thread's stack. Samples are saved as collapsed stacks,
+# one line per distinct stack with its count, which flamegraph.pl and speedscope read.
+SAMPLE_INTERVAL = 0.01
+
+# Frames kept per allocation by tracemalloc, and allocation sites listed per snapshot
+TRACE_FRAMES = 10
+TOP_ALLOCATIONS = 30
+
+# Functions listed in the merged cProfile report, by cumulative and by own time
+REPORT_LINES = 60
+
+
+def _frame_name(code):
+    return '{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class StackSampler(object):
+    '''
+    Samples the stacks of all threads from a background thread, so that the listing
+    page threads are profiled along with the main one. Stacks are rooted at the current
+    region, then main or thread.
+    '''
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+
+        self.interval = interval
+        self.region = ''
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+
+        self._main = threading.current_thread().ident
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _run(self):
+
+        own = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append('main' if ident == self._main else 'thread')
+                stack.append(self.region or 'run')
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+
+    def stop(self):
+
+        self._stop.set()
+        self._thread.join()
+
+
+    def write(self, fname):
+
+        with open(fname, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+class Profiler(object):
+    '''
+    Profiles one scraper run: cProfile on the thread that calls run(), stack samples of
+    every thread, and memory use at the end of each region, with tracemalloc's top
+    allocation sites when it's available. Each run writes its own files to path, named
+    after the process, which merge() combines into one report.
+    '''
+
+    def __init__(self, path):
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.prefix = os.path.join(path, 'worker-{0}-{1}'.format(os.getpid(), int(time.time() * 1000)))
+        self._profile = cProfile.Profile()
+        self._sampler = StackSampler()
+        self._memory = []  # (region, current bytes, peak bytes)
+
+
+    @property
+    def region(self):
+        return self._sampler.region
+
+
+    @region.setter
+    def region(self, region):
+        if region != self._sampler.region:
+            self._record_memory(self._sampler.region)
+            self._sampler.region = region
+
+
+    def _record_memory(self, region):
+
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+        else:
+            current = None
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self._memory.append((region or 'start', current, peak))
+
+
+    def start(self):
+
+        if tracemalloc is not None:
+            tracemalloc.start(TRACE_FRAMES)
+        self._sampler.start()
+        self._profile.enable()
+
+
+    def stop(self):
+
+        self._profile.disable()
+        self._sampler.stop()
+        self._record_memory(self._sampler.region)
+
+        self._profile.dump_stats(self.prefix + '.prof')
+        self._sampler.write(self.prefix + '.collapsed')
+
+        with open(self.prefix + '.mem.txt', 'w') as f:
+            for region, current, peak in self._memory:
+                f.write('{0}: {1} current, {2:.1f} MB peak\n'.format(
+                    region, '?' if current is None else '{0:.1f} MB'.format(current / 1e6), peak / 1e6))
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                snapshot.dump(self.prefix + '.tracemalloc')
+                tracemalloc.stop()
+                f.write('\nTop allocation sites:\n')
+                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    f.write('{0}\n'.format(stat))
+
+
+def merge(path):
+    '''
+    Combines the files written by the profilers of all workers in path: a cProfile
+    report in profile.txt, with a combined profile.prof, all stack samples in
+    profile.collapsed and the memory records in memory.txt. Returns the report's name.
+    '''
+    prof_files = sorted(glob.glob(os.path.join(path, 'worker-*.prof')))
+    report = os.path.join(path, 'profile.txt')
+
+    if len(prof_files) > 0:
+        with open(report, 'w') as f:
+            stats = pstats.Stats(*prof_files, stream=f)
+            stats.dump_stats(os.path.join(path, 'profile.prof'))
+            f.write('{0} profiles merged\n'.format(len(prof_files)))
+            stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+            stats.sort_stats('tottime').print_stats(REPORT_LINES)
+
+    counts = {}
+    for fname in glob.glob(os.path.join(path, 'worker-*.collapsed')):
+        with open(fname) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                counts[stack] = counts.get(stack, 0) + int(count)
+    with open(os.path.join(path, 'profile.collapsed'), 'w') as f:
+        for stack, count in sorted(counts.items()):
+            f.write('{0} {1}\n'.format(stack, count))
+
+    with open(os.path.join(path, 'memory.txt'), 'w') as f:
+        for fname in sorted(glob.glob(os.path.join(path, 'worker-*.mem.txt'))):
+            with open(fname) as mem:
+                f.write('== {0}\n{1}\n'.format(os.path.basename(fname)[:-8], mem.read()))
+
+    return report
+
+
+if __name__ == '__main__':
+    # python profiling.py DIR merges the files from a profiled run in DIR
+    print(merge(sys.argv[1]))
@@ -0,0 +1,266 @@
+from __future__ import division
+from __future__ import print_function
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+# Seconds between the progress updates a worker sends for the domain it's crawling
+UPDATE_INTERVAL = 5
+
+# Seconds between progress reports, and the span of time throughput is measured over
+REPORT_INTERVAL = 30
+RATE_WINDOW = 120
+
+# A running domain whose counters haven't moved for this many seconds is reported as
+# stalled, which usually means it's being throttled or a request is hanging
+STALL_SECONDS = 300
+
+# Counters shown for each domain, taken from its scraper's metrics (see metrics.py)
+FIELDS = ['search_pages', 'listings', 'detail_fetches', 'rows_written', 'errors']
+
+
+def counts(snapshot):
+    '''
+    Returns the progress counters from a metrics snapshot, for all its regions together.
+    Detail fetches are the listing pages requested from Craigslist, not those read from
+    the page cache.
+    '''
+    totals = dict((field, 0) for field in FIELDS)
+    for name, region, n in snapshot['counters']:
+        if name in ('detail_errors', 'search_errors'):
+            totals['errors'] += n
+        elif name == 'detail_requests':
+            totals['detail_fetches'] += n
+        elif name in totals:
+            totals[name] += n
+    return totals
+
+
+class Heartbeat(object):
+    '''
+    Sends the state and counters of the domain a worker is crawling to queue, when it
+    starts, every interval seconds while it runs and when it's finished.
+    '''
+
+    def __init__(self, queue, domain, metrics=None, interval=UPDATE_INTERVAL):
+
+        self.queue = queue
+        self.domain = domain
+        self.metrics = metrics
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def send(self, state):
+
+        update = {'domain': self.domain, 'state': state, 'pid': os.getpid(), 'time': time.time()}
+        if self.metrics is not None:
+            update['counts'] = counts(self.metrics.snapshot())
+        self.queue.put(update)
+
+
+    def start(self):
+
+        self.send('running')
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _run(self):
+
+        while not self._stop.wait(self.interval):
+            self.send('running')
+
+
+    def stop(self, state):
+
+        self._stop.set()
+        self._thread.join()
+        self.send(state)
+
+
+class ProgressBoard(object):
+    '''
+    Keeps the state and counters of every domain in a run, from the updates the workers
+    send to queue, and prints a report every interval seconds: throughput, domains
+    running, finished and stalled, and an estimate of the time left. With fname, the
+    same is written there as JSON after each report.
+
+    The estimate uses the listings expected in each domain, from its rate of new
+    listings or its count in the previous run. Domains without history are assumed to
+    be average, and without any history the estimate goes by domains finished.
+
+    Once started, the board runs in a process of its own, like logqueue.QueueListener,
+    so the scheduler has no threads of its own while its pool forks workers.
+    '''
+
+    def __init__(self, queue, domains, expected=None, fname=None, interval=REPORT_INTERVAL):
+
+        self.queue = queue
+        self.fname = fname
+        self.interval = interval
+        self.st_time = time.time()
+        self.expected = dict((d, n) for d, n in (expected or {}).items() if n is not None)
+        self.domains = dict((domain, {'state': 'queued', 'counts': dict((f, 0) for f in FIELDS),
+                                      'changed': None})
+                            for domain in domains)
+        self._samples = []  # (time, totals), for throughput over the last RATE_WINDOW
+        self._process = None
+
+
+    def update(self, update):
+
+        domain = self.domains.setdefault(update['domain'], {'state': 'queued', 'changed': None,
+                                                            'counts': dict((f, 0) for f in FIELDS)})
+        if domain['state'] == 'queued':
+            domain['started'] = update['time']
+        new_counts = update.get('counts', domain['counts'])
+        if new_counts != domain['counts'] or domain['state'] != update['state']:
+            domain['changed'] = update['time']
+        domain['counts'] = new_counts
+        domain['state'] = update['state']
+        domain['pid'] = update['pid']
+
+
+    def totals(self):
+
+        totals = dict((field, 0) for field in FIELDS)
+        for domain in self.domains.values():
+            for field in FIELDS:
+                totals[field] += domain['counts'][field]
+        return totals
+
+
+    def throughput(self, totals, now):
+        '''
+        Per second rates of the counters over the last RATE_WINDOW seconds.
+        '''
+        self._samples.append((now, totals))
+        while len(self._samples) > 2 and self._samples[1][0] <= now - RATE_WINDOW:
+            self._samples.pop(0)
+        then, old = self._samples[0]
+        if now - then <= 0:
+            return dict((field, 0.0) for field in FIELDS)
+        return dict((field, (totals[field] - old[field]) / (now - then)) for field in FIELDS)
+
+
+    def time_left(self, rates, now):
+        '''
+        Seconds until the domains still queued or running are done, or None if there's
+        nothing to go on yet.
+        '''
+        left = [(name, d) for name, d in self.domains.items() if d['state'] in ('queued', 'running')]
+        if len(left) == 0:
+            return 0
+
+        if len(self.expected) > 0 and rates['listings'] > 0:
+            average = sum(self.expected.values()) / len(self.expected)
+            listings_left = sum(max(self.expected.get(name, average) - d['counts']['listings'], 0)
+                                for name, d in left)
+            return listings_left / rates['listings']
+
+        finished = [d for d in self.domains.values() if d['state'] not in ('queued', 'running')]
+        if len(finished) == 0:
+            return None
+        elapsed = now - self.st_time
+        return elapsed * len(left) / len(finished)
+
+
+    def report(self):
+        '''
+        Returns the current progress as a dict, as it's saved to fname.
+        '''
+        now = time.time()
+        totals = self.totals()
+        rates = self.throughput(totals, now)
+        states = {}
+        for domain in self.domains.values():
+            states[domain['state']] = states.get(domain['state'], 0) + 1
+        stalled = sorted(name for name, d in self.domains.items()
+                         if d['state'] == 'running' and d['changed'] is not None
+                         and now - d['changed'] > STALL_SECONDS)
+
+        return {'time': now, 'elapsed': now - self.st_time, 'states': states,
+                'totals': totals, 'rates': rates, 'time_left': self.time_left(rates, now),
+                'stalled': stalled, 'domains': self.domains}
+
+
+    def print_report(self, report):
+
+        rates = report['rates']
+        states = report['states']
+        print("[{0:.0f}s] {1} of {2} regions done, {3} running, {4} failed. {5:.1f} listings/s, "
+              "{6:.1f} detail pages/s, {7:.1f} rows written/s, {8} errors. {9}".format(
+                  report['elapsed'], states.get('ok', 0), len(self.domains),
+                  states.get('running', 0), states.get('error', 0) + states.get('aborted', 0),
+                  rates['listings'],
+                  rates['detail_fetches'], rates['rows_written'], report['totals']['errors'],
+                  'About {0:.0f} seconds left.'.format(report['time_left'])
+                  if report['time_left'] is not None else ''))
+
+        running = sorted((name, d) for name, d in self.domains.items() if d['state'] == 'running')
+        for name, d in running:
+            c = d['counts']
+            print("    {0}: {1} pages, {2} listings, {3} rows written, {4} errors, {5:.0f}s{6}".format(
+                name, c['search_pages'], c['listings'], c['rows_written'], c['errors'],
+                report['time'] - d.get('started', report['time']),
+                ' STALLED' if name in report['stalled'] else ''))
+
+
+    def write(self, report):
+
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        os.rename(tmp_fname, self.fname)
+
+
+    def start(self):
+
+        self._process = multiprocessing.Process(target=self._run)
+        self._process.daemon = True
+        self._process.start()
+
+
+    def _run(self):
+
+        next_report = time.time() + self.interval
+        while True:
+            try:
+                update = self.queue.get(timeout=max(next_report - time.time(), 0.01))
+            except Empty:
+                update = False
+            if update is None:
+                break
+            if update:
+                self.update(update)
+            if time.time() >= next_report:
+                self._report()
+                next_report = time.time() + self.interval
+        self._report(quiet=True)
+
+
+    def _report(self, quiet=False):
+
+        report = self.report()
+        if not quiet:
+            self.print_report(report)
+        if self.fname is not None:
+            self.write(report)
+
+
+    def stop(self):
+        '''
+        Takes the updates still in the queue, saves a last report, then stops.
+        '''
+        self.queue.put(None)
+        self._process.join()
@@ -0,0 +1,170 @@
+from __future__ import division
+import fcntl
+import json
+import logging
+import time
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+# Request budgets, in requests per second. The global budget is shared by every process
+# using the same state file, since Craigslist throttles by IP rather than by region.
+RATE = 4.0
+HOST_RATE = 2.0
+BURST = 5  # requests that can go out back to back after an idle period
+
+# When Craigslist pushes back, budgets are cut by BACKOFF and requests pause for
+# COOLDOWN seconds. Each healthy response then adds RECOVERY back, up to the limits.
+MIN_RATE = 0.1
+BACKOFF = 0.5
+RECOVERY = 0.02
+COOLDOWN = 60
+
+STATE_FILE = '/tmp/scraper2-ratelimit.json'
+
+# Text that shows up on Craigslist's block and captcha pages
+THROTTLE_MARKERS = [b'This IP has been automatically blocked', b'g-recaptcha']
+THROTTLE_STATUS = [403, 429]
+
+
+def is_throttled(response):
+    '''
+    Checks whether a response is Craigslist telling us to slow down.
+    '''
+    if response.status_code in THROTTLE_STATUS:
+        return True
+
+    head = response.content[:4096]
+    return any(marker in head for marker in THROTTLE_MARKERS)
+
+
+class RateLimiter(object):
+    '''
+    Token bucket rate limiter with a global budget and a budget per host. The buckets
+    live in a small JSON file protected by a file lock, so that all the worker
+    processes on a machine draw from the same budget.
+    '''
+
+    def __init__(
+            self,
+            fname = STATE_FILE,
+            rate = RATE,
+            host_rate = HOST_RATE,
+            burst = BURST,
+            min_rate = MIN_RATE,
+            backoff = BACKOFF,
+            recovery = RECOVERY,
+            cooldown = COOLDOWN):
+
+        self.fname = fname
+        self.max_rates = {'*': rate}
+        self.host_rate = host_rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.backoff = backoff
+        self.recovery = recovery
+        self.cooldown = cooldown
+
+
+    def _max_rate(self, key):
+        return self.max_rates.get(key, self.host_rate)
+
+
+    def _locked(self, func, *args):
+        '''
+        Loads the shared state under an exclusive lock, applies func to it, and saves
+        it again. Returns whatever func returns.
+        '''
+        with open(self.fname, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+
+                result = func(state, time.time(), *args)
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        return result
+
+
+    def _bucket(self, state, now, key):
+        '''
+        Returns the bucket for key, topped up with the tokens earned since it was last
+        used.
+        '''
+        max_rate = self._max_rate(key)
+        b = state.setdefault(key, {'tokens': self.burst, 'rate': max_rate,
+                                   'updated': now, 'blocked_until': 0})
+        b['rate'] = min(b['rate'], max_rate)
+        b['tokens'] = min(self.burst, b['tokens'] + (now - b['updated']) * b['rate'])
+        b['updated'] = now
+        return b
+
+
+    def _take(self, state, now, host):
+        '''
+        Takes a token from the global and host buckets if both have one. Otherwise
+        returns the number of seconds to wait before trying again.
+        '''
+        buckets = [self._bucket(state, now, key) for key in ('*', host)]
+
+        blocked_until = max(b['blocked_until'] for b in buckets)
+        if blocked_until > now:
+            return blocked_until - now
+
+        if all(b['tokens'] >= 1 for b in buckets):
+            for b in buckets:
+                b['tokens'] -= 1
+            return 0
+
+        return max((1 - b['tokens']) / b['rate'] for b in buckets if b['tokens'] < 1)
+
+
+    def _adjust(self, state, now, host, throttled):
+
+        for key in ('*', host):
+            b = self._bucket(state, now, key)
+            if throttled:
+                # Responses to requests already in flight don't count twice
+                if b['blocked_until'] <= now:
+                    b['rate'] = max(self.min_rate, b['rate'] * self.backoff)
+                b['tokens'] = 0
+                b['blocked_until'] = now + self.cooldown
+            else:
+                b['rate'] = min(self._max_rate(key), b['rate'] + self.recovery)
+
+
+    def wait(self, url):
+        '''
+        Blocks until a request to url fits in the budget.
+        '''
+        host = urlparse(url).netloc
+        delay = self._locked(self._take, host)
+        while delay > 0:
+            time.sleep(delay)
+            delay = self._locked(self._take, host)
+
+
+    def update(self, url, response):
+        '''
+        Slows down all processes if the response shows that we're being throttled, and
+        speeds back up a little if it doesn't.
+        '''
+        host = urlparse(url).netloc
+        throttled = is_throttled(response)
+        if throttled:
+            logging.warning('THROTTLED BY {0} (HTTP {1}). BACKING OFF FOR {2} SECONDS'.format(
+                host, response.status_code, self.cooldown))
+        self._locked(self._adjust, host, throttled)
+        return throttled
@@ -0,0 +1,95 @@
+from datetime import datetime as dt
+from lxml import etree
+
+# XPath queries for the search results page, compiled once rather than for every row
+RESULT_ROWS = etree.XPath('//li[@class="result-row"]')
+RESULT_INFO = etree.XPath('p[@class="result-info"]')
+NEXT_PAGE = etree.XPath('//a[@title="next page"]/@href')
+
+TS_FORMAT = '%Y-%m-%d %H:%M'
+
+# Result timestamps only have minute resolution, so most rows on a page share one
+_ts_cache = {}
+
+
+def parse_timestamp(ts):
+    '''
+    Memoized version of dt.strptime(ts, TS_FORMAT).
+    '''
+    parsed = _ts_cache.get(ts)
+    if parsed is None:
+        if len(_ts_cache) > 100000:
+            _ts_cache.clear()
+        parsed = _ts_cache[ts] = dt.strptime(ts, TS_FORMAT)
+    return parsed
+
+
+def _to_int(value):
+    '''
+    Turns strings of digits into ints and leaves anything else alone, so that values
+    are written to the CSV files exactly as before.
+    '''
+    if isinstance(value, (str, type(u''))) and value.isdigit():
+        return int(value)
+    return value
+
+
+def _int_prefix(text, label):
+    '''
+    Bedrooms and square footage have the format "xx 1br xx 450ft xx". Returns the
+    number in front of label, or 0 if it isn't there.
+    '''
+    for s in text.split(' '):
+        if label in s:
+            return _to_int(s.strip(label))
+    return 0
+
+
+def _first_text(el):
+    if el.text is not None:
+        return el.text
+    texts = el.xpath('text()')
+    return texts[0] if len(texts) > 0 else ''
+
+
+def parse_result_row(item):
+    '''
+    Parses one row of search results in a single pass over its elements. Returns
+    [pid, dt, url, title, price, neighb, beds, sqft], with price, beds and sqft as ints
+    when they're present. Missing prices are '' and missing beds or sqft are 0, as in
+    the original parser. Raises IndexError if the row is missing its timestamp, url
+    or title.
+    '''
+    pid = item.attrib['data-pid']  # post id, always present
+    info = RESULT_INFO(item)[0]
+
+    ts = url = title = None
+    price = neighb = ''
+    beds = sqft = 0
+
+    for child in info:
+        tag = child.tag
+        if tag == 'time':
+            if ts is None:
+                ts = child.get('datetime')
+        elif tag == 'a':
+            if url is None:
+                url = child.get('href')
+            if title is None and child.text is not None:
+                title = child.text
+        elif tag == 'span' and child.get('class') == 'result-meta':
+            for span in child:
+                cls = span.get('class')
+                if cls == 'result-price':
+                    price = _to_int(_first_text(span).strip('$'))
+                elif cls == 'result-hood':
+                    neighb = _first_text(span).strip(" ").strip("(").strip(")")
+                elif cls == 'housing':
+                    bedsqft = _first_text(span)
+                    beds = _int_prefix(bedsqft, 'br')  # appears as "1br" to "8br" or missing
+                    sqft = _int_prefix(bedsqft, 'ft')  # appears as "000ft" or missing
+
+    if ts is None or url is None or title is None:
+        raise IndexError('search result {0} is missing its timestamp, url or title'.format(pid))
+
+    return [pid, ts, url, title, price, neighb, beds, sqft]
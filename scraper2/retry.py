@@ -0,0 +1,178 @@
+from __future__ import division
+import logging
+import random
+import threading
+import time
+import requests
+import ratelimit
+
+# Failed requests are tried again up to RETRIES times, after a random delay of up to
+# BACKOFF * 2 ** attempt seconds, capped at MAX_BACKOFF ("full jitter"), so that the
+# threads and processes that failed together don't all come back at the same moment.
+RETRIES = 3
+BACKOFF = 1.0
+MAX_BACKOFF = 60
+
+# Consecutive failed requests after which a domain is given up for the rest of the run.
+# A successful request resets the count. Being throttled gives the domain up straight
+# away: the rate limiter has already slowed every worker down, and each retry would only
+# extend the cooldown. The run as a whole stops after scheduler.MAX_ABORTED domains in a
+# row are given up, which counts across all the worker processes.
+DOMAIN_FAILURES = 8
+
+# How a request turned out: a usable response, a problem worth retrying, Craigslist
+# throttling us, which isn't retried, or an error that would only happen again
+OK = 'ok'
+RETRY = 'retry'
+THROTTLED = 'throttled'
+FATAL = 'fatal'
+
+RETRY_ERRORS = (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError)
+
+
+class FetchFailed(Exception):
+    '''
+    A request that still failed after all its retries.
+    '''
+
+
+class CircuitOpen(Exception):
+    '''
+    Raised instead of sending a request once a circuit breaker has tripped.
+    '''
+
+
+def classify(response=None, error=None):
+    '''
+    Returns OK, RETRY, THROTTLED or FATAL for the response to a request, or for the
+    exception it raised. Error statuses other than throttling and 5xx, like the 404 of
+    a deleted listing, count as OK: the request worked and the caller deals with them.
+    '''
+    if error is not None:
+        return RETRY if isinstance(error, RETRY_ERRORS) else FATAL
+    if ratelimit.is_throttled(response):
+        return THROTTLED
+    if response.status_code >= 500:
+        return RETRY
+    return OK
+
+
+class CircuitBreaker(object):
+    '''
+    Counts consecutive failures, and trips after failures of them in a row. Safe to use
+    from the listing page threads.
+    '''
+
+    def __init__(self, failures, name=''):
+
+        self.failures = failures
+        self.name = name
+        self.count = 0
+        self.tripped = False
+        self.reason = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def is_open(self):
+        return self.tripped
+
+
+    def check(self):
+
+        if self.tripped:
+            raise CircuitOpen('{0}: {1}'.format(self.name, self.reason))
+
+
+    def success(self):
+
+        with self._lock:
+            if not self.tripped:
+                self.count = 0
+
+
+    def failure(self):
+
+        with self._lock:
+            self.count += 1
+            if self.count >= self.failures and not self.tripped:
+                self.tripped = True
+                self.reason = 'failed {0} requests in a row'.format(self.count)
+                logging.warning('{0} FAILED {1} REQUESTS IN A ROW. GIVING UP ON IT'.format(
+                    self.name.upper(), self.count))
+
+
+    def trip(self, reason):
+        '''
+        Trips the breaker straight away, without waiting for more failures.
+        '''
+        with self._lock:
+            self.count += 1
+            if not self.tripped:
+                self.tripped = True
+                self.reason = reason
+                logging.warning('{0}: {1}. GIVING UP ON IT'.format(self.name.upper(), reason))
+
+
+class RetryPolicy(object):
+    '''
+    Sends requests with retries and backoff, and reports how each attempt went to
+    breaker. breaker is set by the scraper as it moves from one domain to the next.
+    '''
+
+    def __init__(self, retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = None
+
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+    def call(self, send, url):
+        '''
+        Returns the response from send(), a function that makes the request for url.
+        Raises FetchFailed when the retries run out or the request was throttled, which
+        also trips the breaker, CircuitOpen when the breaker is open, and errors that
+        are not worth retrying straight away.
+        '''
+        breaker = self.breaker
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.check()
+
+            response, error = None, None
+            try:
+                response = send()
+            except Exception as e:
+                error = e
+            outcome = classify(response, error)
+
+            if outcome == OK:
+                if breaker is not None:
+                    breaker.success()
+                return response
+            if outcome == FATAL:
+                raise error
+            if outcome == THROTTLED:
+                problem = 'HTTP {0}, throttled'.format(response.status_code)
+                if breaker is not None:
+                    breaker.trip(problem)
+                raise FetchFailed('{0} at {1}'.format(problem, url))
+
+            if breaker is not None:
+                breaker.failure()
+            problem = '{0}: {1}'.format(type(error).__name__, error) if error is not None \
+                else 'HTTP {0}'.format(response.status_code)
+            if attempt >= self.retries:
+                raise FetchFailed('{0} after {1} attempts at {2}'.format(problem, attempt + 1, url))
+
+            delay = self.delay(attempt)
+            logging.info('{0} at {1}. Retrying in {2:.1f} seconds'.format(problem, url, delay))
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,413 @@
+from __future__ import division
+from __future__ import print_function
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from datetime import datetime as dt
+import metrics
+import logqueue
+import profiling
+import progress
+
+# Number of domains crawled at the same time. Each worker process already fetches
+# listing pages with several threads, so this can stay well below the number of domains.
+WORKERS = 16
+
+# Worker processes are replaced after this many domains, which keeps memory from
+# growing over a long run
+MAX_DOMAINS_PER_WORKER = 20
+
+# The run stops after this many domains in a row were given up because their requests
+# kept failing, which means Craigslist is throttling or blocking us. This is the breaker
+# for the run as a whole, since it sees the domains of every worker process, where a
+# scraper's own breakers only see its domains (see retry.py)
+MAX_ABORTED = 3
+
+# Per-domain stats that are added up when a scraper crawls several categories
+COUNTS = ['listings', 'rows', 'cleaned', 'written', 'dupes', 'seen', 'filtered']
+
+# Adaptive polling. The history keeps each domain's rate of new listings per hour, and
+# its next poll is timed for when it will have about POLL_FILL of a results window of
+# new listings (Craigslist shows at most 2,500 results per search). Busy regions are
+# then crawled before they overflow, and quiet ones only every MAX_POLL_HOURS. New
+# rates are averaged with the old ones, giving RATE_SMOOTHING weight to the new one.
+POLL_WINDOW = 2500
+POLL_FILL = 0.8
+MIN_POLL_HOURS = 0.25
+MAX_POLL_HOURS = 12
+RATE_SMOOTHING = 0.5
+
+# Queue for progress updates, in worker processes of a run that reports its progress
+_progress_queue = None
+
+
+def load_history(fname):
+    '''
+    Reads per-domain stats saved by a previous run, or returns an empty dict if there
+    aren't any yet.
+    '''
+    if fname is None or not os.path.exists(fname):
+        return {}
+
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning('Could not read domain history from {0}'.format(fname))
+        return {}
+
+
+def save_history(fname, history):
+
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.rename(tmp_fname, fname)
+
+
+def order_domains(domains, history):
+    '''
+    Puts the busiest domains first, so that the slowest regions don't start at the end
+    of the run. Busyness is the time a domain took in the previous run. Domains without
+    history keep their order from the domain list and go after the ones we know about.
+    '''
+    def weight(item):
+        i, domain = item
+        past = history.get(domain)
+        if past is None:
+            return (0, i)
+        return (-past.get('seconds', 0), i)
+
+    return [domain for i, domain in sorted(enumerate(domains), key=weight)]
+
+
+def _epoch(ts):
+    return time.mktime(ts.timetuple())
+
+
+def _shard_leaves(domain, history):
+    shards = history.get(domain, {}).get('shards')
+    if not shards:
+        return [domain]
+    return [leaf for shard in shards for leaf in _shard_leaves(shard, history)]
+
+
+def _unshard(domain, history, earliest_ts, latest_ts, adaptive):
+    '''
+    Checks whether the window of a domain that was split into shards is now expected to
+    fit in one search, from its shards' rates of new listings. If so, the domain's
+    history gets the polling fields of its shards combined, and True is returned.
+    '''
+    leaves = [history.get(leaf, {}) for leaf in _shard_leaves(domain, history)]
+    if latest_ts is None or any(leaf.get('rate') is None for leaf in leaves):
+        return False
+
+    polled = [leaf.get('polled_until') for leaf in leaves]
+    polled_until = min(polled) if adaptive and None not in polled else None
+    start = polled_until if polled_until is not None else \
+        _epoch(earliest_ts) if earliest_ts is not None else None
+    if start is None:
+        return False
+
+    rate = sum(leaf['rate'] for leaf in leaves)
+    hours = max(_epoch(min(latest_ts, dt.now())) - start, 0) / 3600
+    if rate * hours >= POLL_WINDOW * POLL_FILL:
+        return False
+
+    fields = {'rate': rate}
+    if adaptive:
+        fields.update(polled_until=polled_until,
+                      next_poll=min(leaf.get('next_poll', 0) for leaf in leaves))
+    history[domain] = dict(history.get(domain, {}), **fields)
+    return True
+
+
+def _seed_shards(domain, history):
+    '''
+    Gives the shards a domain was just split into the polling fields of the domain,
+    since its crawl covered them up to the same time. Otherwise new shards would be due
+    at once and crawled again from the start of the window.
+    '''
+    past = history.get(domain, {})
+    if past.get('polled_until') is None:
+        return
+    for shard in past.get('shards') or []:
+        shard_past = history.get(shard, {})
+        if (shard_past.get('polled_until') or 0) < past['polled_until']:
+            history[shard] = dict(shard_past, polled_until=past['polled_until'],
+                                  next_poll=past.get('next_poll', 0))
+
+
+def expand_domains(domains, history, earliest_ts=None, latest_ts=None, adaptive=False):
+    '''
+    Replaces domains whose search had to be split into shards last time with those
+    shards, so that they're crawled as separate jobs in parallel. Shards that were split
+    again are expanded in turn.
+
+    Domains whose next time window is expected to fit in one search again, like after a
+    busy spell or with a shorter window, are crawled as one job instead. See _unshard.
+    Their shards are dropped from the history once a crawl finishes without splitting.
+    '''
+    expanded = []
+    for domain in domains:
+        shards = history.get(domain, {}).get('shards')
+        if shards and not _unshard(domain, history, earliest_ts, latest_ts, adaptive):
+            # str, since the history's JSON gives unicode on Python 2 and the scraper
+            # expects the same type as the domain list
+            expanded.extend(expand_domains([str(shard) for shard in shards], history,
+                                           earliest_ts, latest_ts, adaptive))
+        else:
+            expanded.append(domain)
+    return expanded
+
+
+def poll_interval(rate):
+    '''
+    Returns the hours until a domain with rate new listings per hour should be crawled
+    again.
+    '''
+    if rate <= 0:
+        return MAX_POLL_HOURS
+    return min(max(POLL_WINDOW * POLL_FILL / rate, MIN_POLL_HOURS), MAX_POLL_HOURS)
+
+
+def update_rate(past, listings, earliest_ts, latest_ts):
+    '''
+    Returns the polling fields for a domain's history after a crawl that found listings
+    posted between earliest_ts and latest_ts: its smoothed rate of listings per hour,
+    the time it has been crawled up to and the time of its next poll, as epoch seconds.
+    '''
+    latest_ts = min(latest_ts, dt.now())  # some scripts look a little into the future
+    hours = (latest_ts - earliest_ts).total_seconds() / 3600
+    if hours <= 0:
+        return {}
+
+    rate = listings / hours
+    if past.get('rate') is not None:
+        rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * past['rate']
+
+    polled_until = _epoch(latest_ts)
+    return {'rate': rate, 'polled_until': polled_until,
+            'next_poll': polled_until + poll_interval(rate) * 3600}
+
+
+def due_domains(domains, history, earliest_ts, latest_ts):
+    '''
+    Returns (domain, earliest_ts) for the domains whose next poll is due by latest_ts.
+    Each one is crawled from where its last crawl stopped, so nothing is missed however
+    long it waited. Domains without polling history start from earliest_ts.
+    '''
+    due = []
+    for domain in domains:
+        past = history.get(domain, {})
+        if past.get('next_poll', 0) > _epoch(latest_ts):
+            continue
+        if past.get('polled_until') is not None:
+            due.append((domain, dt.fromtimestamp(past['polled_until'])))
+        else:
+            due.append((domain, earliest_ts))
+    return due
+
+
+def expected_listings(past, earliest_ts, latest_ts):
+    '''
+    Returns the number of listings a domain is expected to have between earliest_ts and
+    latest_ts, from its history, or None if there's no history.
+    '''
+    if past.get('rate') is not None and earliest_ts is not None and latest_ts is not None:
+        latest_ts = min(latest_ts, dt.now())
+        return max(past['rate'] * (latest_ts - earliest_ts).total_seconds() / 3600, 0)
+    return past.get('listings')
+
+
+def init_worker(log_queue, progress_queue):
+    '''
+    Initializer of the scheduler's worker processes. Sends their log records and
+    progress updates to the queues read by the main process.
+    '''
+    global _progress_queue
+    if log_queue is not None:
+        logqueue.init_worker(log_queue)
+    _progress_queue = progress_queue
+
+
+def scrape_domain(job):
+    '''
+    Runs a scraper on a single domain. This is the function executed by the worker
+    processes, so it returns a plain dict and never raises.
+    '''
+    scraper_cls, scraper_kwargs, domain, profile_dir = job
+    st_time = time.time()
+    result = {'domain': domain, 'status': 'ok', 'pid': os.getpid()}
+    heartbeat = None
+
+    try:
+        scraper = scraper_cls(domains=[domain], **scraper_kwargs)
+        if _progress_queue is not None:
+            heartbeat = progress.Heartbeat(_progress_queue, domain, getattr(scraper, 'metrics', None))
+            heartbeat.start()
+        stats = scraper.run(profile=profile_dir) if profile_dir is not None else scraper.run()
+        if stats:
+            result.update(stats[0])
+            result['domain'] = domain
+            if len(stats) > 1:
+                # Several categories crawled for the domain: totals, and each one's own stats
+                for key in COUNTS:
+                    result[key] = sum(category_stats.get(key, 0) for category_stats in stats)
+                result['categories'] = stats
+            aborted = [category_stats['aborted'] for category_stats in stats if 'aborted' in category_stats]
+            if len(aborted) > 0:
+                result['aborted'] = aborted[0]
+        if getattr(scraper, 'metrics', None) is not None:
+            result['metrics'] = scraper.metrics.snapshot()
+    except Exception:
+        result['status'] = 'error'
+        result['error'] = traceback.format_exc()
+
+    if heartbeat is not None:
+        heartbeat.stop('aborted' if 'aborted' in result else result['status'])
+    result['seconds'] = time.time() - st_time
+    return result
+
+
+def run_domains(scraper_cls, domains, scraper_kwargs=None, workers=WORKERS,
+                history_fname=None, adaptive=False, metrics_fname=None, log_fname=None,
+                profile_dir=None, progress_fname=None, report_interval=progress.REPORT_INTERVAL):
+    '''
+    Crawls each domain with a fixed number of worker processes pulling from a shared
+    queue. Prints a line as each domain finishes, and every report_interval seconds a
+    report of the progress of the whole run, from counters the workers send while they
+    crawl: throughput, the domains running and stalled, and an estimate of the time
+    left. With progress_fname, the report is also saved there as JSON. See progress.py.
+    Returns the per-domain results, in the order they finished.
+
+    With adaptive, only the domains that are due are crawled, each from where its last
+    crawl stopped up to latest_ts in scraper_kwargs. See due_domains.
+
+    Domains that a scraper gave up on because their requests kept failing keep their
+    history, so they're crawled again from the same point. After MAX_ABORTED of them in
+    a row the run stops, since Craigslist is then most likely throttling us.
+
+    With metrics_fname, the stage metrics of all the workers are combined and written
+    there at the end. See metrics.py for the formats.
+
+    With log_fname, the workers send their log records through a queue to this process,
+    which writes them all to that one file as JSON lines. See logqueue.py.
+
+    With profile_dir, each worker profiles its crawls and saves the results in a new
+    subdirectory for the run, and they're combined at the end into a report and a
+    collapsed stack file for flame graphs. See profiling.py.
+    '''
+    scraper_kwargs = scraper_kwargs or {}
+    if profile_dir is not None:
+        # A directory of its own, so only this run's worker files are merged
+        profile_dir = os.path.join(profile_dir, 'run-{0}-{1}'.format(
+            dt.now().strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        os.makedirs(profile_dir)
+
+    history = load_history(history_fname)
+    ordered = order_domains(expand_domains(domains, history, scraper_kwargs.get('earliest_ts'),
+                                           scraper_kwargs.get('latest_ts'), adaptive), history)
+    if adaptive:
+        windows = due_domains(ordered, history, scraper_kwargs['earliest_ts'],
+                              scraper_kwargs['latest_ts'])
+        print("{0} of {1} regions are due.".format(len(windows), len(ordered)))
+    else:
+        windows = [(domain, scraper_kwargs.get('earliest_ts')) for domain in ordered]
+    jobs = [(scraper_cls, dict(scraper_kwargs, earliest_ts=earliest_ts) if adaptive
+             else scraper_kwargs, domain, profile_dir) for domain, earliest_ts in windows]
+    earliest = dict(windows)
+    if len(jobs) == 0:
+        return []
+    workers = max(1, min(workers, len(jobs)))
+
+    results = []
+    run_metrics = metrics.Metrics()
+
+    # The log listener and the progress board run in processes of their own, so this
+    # process has no threads of its own that could hold a lock when the pool forks its
+    # workers, or replaces one after MAX_DOMAINS_PER_WORKER domains
+    listener = None
+    log_queue = None
+    if log_fname is not None:
+        log_queue = multiprocessing.Queue()
+        listener = logqueue.QueueListener(log_queue, logqueue.json_file_handler(log_fname))
+        listener.start()
+
+    progress_queue = multiprocessing.Queue()
+    board = progress.ProgressBoard(
+        progress_queue, [job[2] for job in jobs],
+        expected=dict((domain, expected_listings(history.get(domain, {}), earliest_ts,
+                                                 scraper_kwargs.get('latest_ts')))
+                      for domain, earliest_ts in windows),
+        fname=progress_fname, interval=report_interval)
+    board.start()
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                initargs=(log_queue, progress_queue),
+                                maxtasksperchild=MAX_DOMAINS_PER_WORKER)
+    aborted_in_row = 0
+    try:
+        for result in pool.imap_unordered(scrape_domain, jobs):
+            if 'metrics' in result:
+                run_metrics.merge(result.pop('metrics'))
+            results.append(result)
+            state = 'aborted' if 'aborted' in result else result['status']
+            progress_queue.put({'domain': result['domain'], 'state': state,
+                                'pid': result['pid'], 'time': time.time()})
+
+            print("{0} {1} in {2:.1f} seconds: {3} listings, {4} rows, {5} written.".format(
+                result['domain'], {'ok': 'finished', 'aborted': 'STOPPED EARLY'}.get(state, 'FAILED'),
+                result['seconds'], result.get('listings', '?'), result.get('rows', '?'),
+                result.get('written', '?')))
+
+            if state == 'aborted':
+                # Its history stays as it was, so the next run crawls it from the same point
+                print(result['aborted'])
+                aborted_in_row += 1
+                if aborted_in_row >= MAX_ABORTED:
+                    print("Stopping the run after {0} regions in a row were stopped early.".format(
+                        aborted_in_row))
+                    break
+                continue
+            aborted_in_row = 0
+
+            if result['status'] == 'ok':
+                domain = result['domain']
+                past = history.get(domain, {})
+                history[domain] = dict(
+                    (k, v) for k, v in result.items() if k not in ('status', 'pid'))
+                if 'listings' in result and earliest[domain] is not None \
+                        and scraper_kwargs.get('latest_ts') is not None:
+                    history[domain].update(update_rate(
+                        past, result['listings'], earliest[domain], scraper_kwargs['latest_ts']))
+                _seed_shards(domain, history)
+            else:
+                print(result['error'])
+
+        if aborted_in_row >= MAX_ABORTED:
+            pool.terminate()
+        else:
+            pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        board.stop()
+        if listener is not None:
+            listener.stop()
+
+    if history_fname is not None:
+        save_history(history_fname, history)
+
+    if metrics_fname is not None:
+        run_metrics.write(metrics_fname)
+
+    if profile_dir is not None:
+        print("Profile report in " + profiling.merge(profile_dir))
+
+    return results
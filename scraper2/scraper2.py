@@ -2,21 +2,29 @@ from __future__ import division
 from datetime import datetime as dt
 from datetime import timedelta
 import logging
-import urllib
-import unicodecsv as csv
 from lxml import html
-import requests
 import time
-import sys
-from requests.auth import HTTPProxyAuth
 import pandas as pd
-import numpy as np
-import json
 import psycopg2
-import shutil
-import os
-import glob
-import subprocess
+from multiprocessing.pool import ThreadPool
+import sessions
+import ratelimit
+import pagecache
+import seenpids
+import prefilter
+import resultparser
+import dbload
+import checkpoint
+import cleaning
+import sinks
+import shards
+import categories
+import geocoder
+import fipscache
+import metrics
+import logqueue
+import profiling
+import retry
 
 # Some defaults, which can be overridden when the class is called
 
@@ -33,9 +41,98 @@ OUT_DIR = '/home/mgardner/scraper2/data/'
 FNAME_BASE = 'data-'  # filename prefix for saved data
 FNAME_TS = True  # append timestamp to filename
 
+# In streaming mode, scraped rows are cleaned, geocoded and written to the database
+# while the region is still being crawled, whenever STREAM_BATCH rows have built up at
+# the end of a page of search results, instead of being read back from the CSV file at
+# the end. The data file is then only written if SAVE_FILE is True.
+STREAM = False
+STREAM_BATCH = 500
+SAVE_FILE = True
+
+# Categories crawled in each domain, like ['apa', 'roo'], one after another over the same
+# connections, rate limit and caches. None crawls just the category in each domain's url.
+# See categories.py for the parsers of each one.
+CATEGORIES = None
+
+# Craigslist returns at most 2,500 results per search. Searches that run out of results
+# at the cap before reaching earliest_ts are split into sub-areas and then price bands,
+# which are crawled one after another and deduplicated by pid. See shards.py. The
+# scheduler crawls the shards of domains that were split last time as separate jobs, in
+# parallel, as long as their time window is still expected to overflow the cap.
+SHARD = True
+
+# Progress through each domain is saved in CHECKPOINT_DIR after every page of search
+# results. With RESUME, a run with the same data file and time window as an interrupted
+# one continues from its checkpoints. Set CHECKPOINT_DIR to None to turn this off.
+CHECKPOINT_DIR = '/home/mgardner/scraper2/checkpoints/'
+RESUME = False
+
+# Format of the regional data files in OUT_DIR, 'csv' or 'parquet'. Parquet files are
+# typed and compressed, and need pyarrow. See sinks.py.
+OUT_FORMAT = 'csv'
+
+# Counters and latency histograms for each stage of the crawl, per region and for the
+# whole run, are written to METRICS_FILE at the end of a run: in the Prometheus text
+# format if the name ends in .prom, and as JSON lines otherwise. See metrics.py.
+METRICS_FILE = None
+
+# Write the log as JSON lines, with only a sample of the per-listing lines and a summary
+# event for each region. When the scheduler is given a log file, its workers send their
+# records to it through a queue instead, in the same format. See logqueue.py.
+LOG_JSON = False
+
 S3_UPLOAD = False
 S3_BUCKET = 'scraper2'
 
+DB_CONN_STR = 'dbname=craigslist user=mgardner host=localhost password=craig port=5432'
+DB_TABLE = 'rental_listings'
+DB_COLUMNS = ['pid', 'date', 'region', 'neighborhood', 'rent', 'bedrooms', 'sqft', 'rent_sqft',
+              'longitude', 'latitude', 'county', 'fips_block', 'state', 'bathrooms']
+DB_BULK = True  # load each region with one multi-row insert rather than row by row
+
+# Census block index built by geocoder.py. When set, listings are geocoded locally and
+# the FCC API is only used for points outside the index.
+GEOCODER_DIR = None
+
+# Census block lookups are cached in this SQLite file by rounded coordinates, shared by
+# all processes and runs. Set to None to look up every listing. See fipscache.py.
+FIPS_CACHE = '/home/mgardner/scraper2/fips_cache.sqlite'
+
+# Index of posting ids that are already stored, built by seenpids.build_index() before
+# a run. Listings in it are skipped without fetching their pages.
+SEEN_PIDS = None
+
+# Listings that _clean_listings would drop are skipped before fetching their pages.
+# See prefilter.py for the available rules, or set to None to fetch everything.
+PREFETCH_FILTER = {'min_price': 1, 'min_sqft': 1}
+
+# Maximum number of listing pages fetched at the same time within one domain. Set to 1
+# to fetch them one after another.
+DETAIL_WORKERS = 8
+
+# Connection pool size per host, and how long to cache DNS lookups. See sessions.py.
+POOL_MAXSIZE = sessions.POOL_MAXSIZE
+DNS_TTL = sessions.DNS_TTL
+
+# Requests per second to Craigslist, shared by all processes on this machine, and per
+# regional host. Set RATE_LIMIT to None to turn off pacing. See ratelimit.py.
+RATE_LIMIT = ratelimit.RATE
+HOST_RATE_LIMIT = ratelimit.HOST_RATE
+RATE_LIMIT_FILE = ratelimit.STATE_FILE
+
+# Failed requests to Craigslist are retried up to RETRIES times, with jittered exponential
+# backoff. After DOMAIN_FAILURES failed requests in a row, or the first one Craigslist
+# throttles, a domain is given up until its next crawl. Stopping the whole run is up to
+# the scheduler (see scheduler.MAX_ABORTED), which sees the domains of every worker.
+# See retry.py.
+RETRIES = retry.RETRIES
+DOMAIN_FAILURES = retry.DOMAIN_FAILURES
+
+# Listing pages are cached on disk by posting id, so overlapping runs don't download
+# them again. Set CACHE_DIR to None to turn off caching. See pagecache.py.
+CACHE_DIR = '/home/mgardner/scraper2/cache/'
+CACHE_TTL = pagecache.TTL
+
 
 class RentalListingScraper(object):
 
@@ -48,7 +145,32 @@ class RentalListingScraper(object):
             fname_base = FNAME_BASE,
             fname_ts = FNAME_TS,
             s3_upload = S3_UPLOAD,
-            s3_bucket = S3_BUCKET):
+            s3_bucket = S3_BUCKET,
+            detail_workers = DETAIL_WORKERS,
+            pool_maxsize = POOL_MAXSIZE,
+            dns_ttl = DNS_TTL,
+            rate_limit = RATE_LIMIT,
+            host_rate_limit = HOST_RATE_LIMIT,
+            rate_limit_file = RATE_LIMIT_FILE,
+            retries = RETRIES,
+            domain_failures = DOMAIN_FAILURES,
+            cache_dir = CACHE_DIR,
+            cache_ttl = CACHE_TTL,
+            seen_pids = SEEN_PIDS,
+            prefetch_filter = PREFETCH_FILTER,
+            db_bulk = DB_BULK,
+            geocoder_dir = GEOCODER_DIR,
+            fips_cache = FIPS_CACHE,
+            stream = STREAM,
+            stream_batch = STREAM_BATCH,
+            save_file = SAVE_FILE,
+            out_format = OUT_FORMAT,
+            checkpoint_dir = CHECKPOINT_DIR,
+            resume = RESUME,
+            shard = SHARD,
+            categories = CATEGORIES,
+            metrics_file = METRICS_FILE,
+            log_json = LOG_JSON):
         
         self.domains = domains
         self.earliest_ts = earliest_ts
@@ -58,121 +180,90 @@ class RentalListingScraper(object):
         self.fname_ts = fname_ts
         self.s3_upload = s3_upload
         self.s3_bucket = s3_bucket
+        self.detail_workers = max(1, int(detail_workers))
+        self.pool_maxsize = max(pool_maxsize, self.detail_workers)
+        self.dns_ttl = dns_ttl
+        self.rate_limit = rate_limit
+        self.host_rate_limit = host_rate_limit
+        self.rate_limit_file = rate_limit_file
+        self.retries = retries
+        self.domain_failures = domain_failures
+        self._retry = None
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self._cache = None
+        self.seen_pids = seen_pids
+        self.prefetch_filter = prefilter.ListingFilter(prefetch_filter)
+        self.db_bulk = db_bulk
+        self._conn = None
+        self.geocoder_dir = geocoder_dir
+        self._geocoder = None
+        self.fips_cache = fips_cache
+        self._fips_cache = None
+        self.stream = stream
+        self.stream_batch = max(1, int(stream_batch))
+        self.save_file = save_file
+        if out_format not in sinks.FORMATS:
+            raise ValueError('Unknown output format {0}'.format(out_format))
+        self.out_format = out_format
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+        self.shard = shard
+        self.categories = categories
+        self.metrics_file = metrics_file
+        self.metrics = metrics.Metrics()
+        self._checkpoints = None
+        self._profiler = None
         self.ts = fname_ts  # Use timestamp as file id
 
         log_fname = '/home/mgardner/scraper2/logs/' + self.fname_base \
                 + (self.ts if self.fname_ts else '') + '.log'
-        logging.basicConfig(filename=log_fname, level=logging.INFO)
+        logqueue.log_to_file(log_fname, structured=log_json)
         
         # Suppress info messages from the 'requests' library
         logging.getLogger('requests').setLevel(logging.WARNING)  
 
 
-    def _get_str(self, list):
+    def _scrapeDetails(self, session, url, category, pid=None):
         '''
-        The xpath() function returns a list of items that may be empty. Most of the time,
-        we want the first of any strings that match the xml query. This helper function
-        returns that string, or null if the list is empty.
+        Downloads a listing page, or reads it from the cache, and returns the fields that
+        category takes from it.
         '''
-        
-        if len(list) > 0:
-            return list[0]
-
-        return ''
-    
-    
-    def _get_int_prefix(self, str, label):
-        '''
-        Bedrooms and square footage have the format "xx 1br xx 450ft xx". This helper 
-        function extracts relevant integers from strings of this format.
-        '''     
-        
-        for s in str.split(' '):
-            if label in s:
-                return s.strip(label)
-                
-        return 0
+        with self.metrics.time('detail_fetch'):
+            content = pagecache.fetch(session, url, pid, self._cache, timeout=30,
+                                      on_request=lambda: self.metrics.count('detail_requests'))
+        with self.metrics.time('detail_parse'):
+            return category.parse_details(html.fromstring(content))
 
 
-    def _toFloat(self, string_value):
-        string_value = string_value.strip()
-        return np.float(string_value) if string_value else np.nan
-        
-
-    def _parseListing(self, item):
+    def _fetch_detail(self, session, url, category, pid):
         '''
-        Note that xpath() returns a list with elements of varying types depending on the
-        query results: xml objects, strings, etc.
+        Wrapper around _scrapeDetails for use in the worker pool. Problems with a single
+        listing page are logged and returned as None, so they don't affect the others.
         '''
-        pid = item.xpath('@data-pid')[0]  # post id, always present
-        info = item.xpath('p[@class="result-info"]')[0]
-        dt = info.xpath('time/@datetime')[0]
-        url = info.xpath('a/@href')[0]
-        if type(info.xpath('a/text()')) == str:
-            title = info.xpath('a/text()')
-        else:
-            title = info.xpath('a/text()')[0]
-        price = self._get_str(info.xpath('span[@class="result-meta"]/span[@class="result-price"]/text()')).strip('$')
-        neighb_raw = info.xpath('span[@class="result-meta"]/span[@class="result-hood"]/text()')
-        if len(neighb_raw) == 0:
-            neighb = ''
-        else:
-            neighb = neighb_raw[0].strip(" ").strip("(").strip(")")
-        housing_raw = info.xpath('span[@class="result-meta"]/span[@class="housing"]/text()')
-        if len(housing_raw) == 0:
-            beds = 0
-            sqft = 0
-        else:
-            bedsqft = housing_raw[0]
-            beds = self._get_int_prefix(bedsqft, "br")  # appears as "1br" to "8br" or missing
-            sqft = self._get_int_prefix(bedsqft, "ft")  # appears as "000ft" or missing
-        
-        return [pid, dt, url, title, price, neighb, beds, sqft]
-        
+        logging.info(url, extra=logqueue.LISTING)
+        try:
+            return self._scrapeDetails(session, url, category, pid=pid)
+        except retry.CircuitOpen:
+            raise
+        except Exception as e:
+            logging.warning("{0}: {1}. Failed to scrape {2}".format(type(e).__name__, e, url))
+            self.metrics.count('detail_errors')
+            return None
+
 
-    def _parseAddress(self, tree):
+    def _fetch_details(self, session, rows, category):
         '''
-        Some listings include an address, but we have to parse it out of an encoded
-        Google Maps url.
+        Fetches the listing pages for rows from one page of search results, using up
+        to detail_workers requests at a time. Results come back in the same order as
+        the rows.
         '''
-        url = self._get_str(tree.xpath('//p[@class="mapaddress"]/small/a/@href'))
-        
-        if '?q=loc' not in url:
-            # That string precedes an address search
-            return ''
-            
-        return urllib.unquote_plus(url.split('?q=loc')[1]).strip(' :')
+        fetch = lambda row: self._fetch_detail(session, row[2], category, row[0])
 
-    
-    def _scrapeLatLng(self, session, url, proxy=True):
-    
-        s = session
-        # if proxy:
-        #     requests.packages.urllib3.disable_warnings()
-        #     authenticator = '87783015bbe2d2f900e2f8be352c414a'
-        #     proxy_str = 'http://' + authenticator + '@' +'workdistribute.charityengine.com:20000'
-        #     s.proxies = {'http': proxy_str, 'https': proxy_str}
-        #     s.auth = HTTPProxyAuth(authenticator,'') 
-
-        page = s.get(url, timeout=30)
-        tree = html.fromstring(page.content)
-        try:
-            baths = tree.xpath('//div[@class="mapAndAttrs"]/p[@class="attrgroup"]/span/b')[1].text[:-2]
-        except:
-            baths = ''
-        map = tree.xpath('//div[@id="map"]')
-
-        # Sometimes there's no location info, and no map on the page        
-        if len(map) == 0:
-            return [baths,'', '', '', '']
-
-        map = map[0]
-        lat = map.xpath('@data-latitude')[0]
-        lng = map.xpath('@data-longitude')[0]
-        accuracy = map.xpath('@data-accuracy')[0]
-        address = self._parseAddress(tree)
-        
-        return [baths, lat, lng, accuracy, address]
+        if self.detail_workers == 1 or len(rows) <= 1:
+            return [fetch(row) for row in rows]
+
+        return self._pool.map(fetch, rows)
 
 
     def _get_fips(self, row):
@@ -181,223 +272,524 @@ class RentalListingScraper(object):
             request = url.format(row['latitude'], row['longitude'])
 
             # TO DO: exception handling
-            response = requests.get(request)
+            response = self._fips_session.get(request)
             data = response.json()
             return pd.Series({'fips_block':data['Block']['FIPS'], 'state':data['State']['code'], 'county':data['County']['name']})
 
 
-    def _clean_listings(self, filename):
+    def _geocode(self, listings):
+        '''
+        Returns the census block, state and county of each listing, from the FIPS cache
+        if it's turned on and from _lookup_fips() for locations that aren't cached.
+        '''
+        if self._fips_cache is None:
+            return self._lookup_fips(listings)
+
+        return self._fips_cache.lookup(listings, self._lookup_fips)
+
 
-        converters = {'neighb':str, 
-              'title':str, 
-              'price':self._toFloat, 
-              'beds':self._toFloat,
-              'baths':self._toFloat, 
-              'pid':str, 
-              'dt':str, 
-              'url':str, 
-              'sqft':self._toFloat, 
-              'sourcepage':str, 
-              'lng':self._toFloat, 
-              'lat':self._toFloat}
+    def _lookup_fips(self, listings):
+        '''
+        Looks up census blocks in the offline index if there is one and with the FCC
+        API otherwise, or for points the index doesn't cover.
+        '''
+        if self._geocoder is None:
+            return listings.apply(self._get_fips, axis=1)
+
+        fips = self._geocoder.lookup(listings['latitude'].values, listings['longitude'].values,
+                                     index=listings.index)
+        missing = fips['fips_block'].isnull()
+        if missing.any():
+            cols = ['county', 'fips_block', 'state']
+            fips.loc[missing, cols] = listings[missing].apply(self._get_fips, axis=1)[cols].values
+
+        return fips
 
-        all_listings = pd.read_csv(filename, converters=converters)
 
+    def _read_listings(self, filename, category=None):
+        '''
+        Reads a data file of scraped rows written by run(). See cleaning.py.
+        '''
+        category = category or categories.get_category(categories.DEFAULT_CATEGORY)
+        with self.metrics.time('read_file'):
+            return category.read(filename)
+
+
+    def _frame(self, rows, colnames):
+        '''
+        Makes a DataFrame from scraped rows, with the same types that _read_listings()
+        gets from the CSV file, so they can be cleaned without the round trip.
+        '''
+        return cleaning.frame(rows, colnames)
+
+
+    def _clean_listings(self, filename, category=None):
+
+        return self._clean_frame(self._read_listings(filename, category), category)
+
+
+    def _clean_frame(self, all_listings, category=None):
+        '''
+        Cleans and geocodes a DataFrame of scraped rows. Returns the cleaned listings
+        and the numbers of rows scraped, with rent and sqft, and geocoded. Categories
+        that aren't geocoded count all their cleaned rows as geocoded.
+        '''
+        category = category or categories.get_category(categories.DEFAULT_CATEGORY)
         if len(all_listings) == 0:
             return [], 0, 0, 0
-        # print('{0} total listings'.format(len(all_listings)))
-        all_listings = all_listings.rename(columns={'price':'rent', 'dt':'date', 'beds':'bedrooms', 'neighb':'neighborhood',
-                                                    'baths':'bathrooms','lng':'longitude', 'lat':'latitude'})
-        all_listings['rent_sqft'] = all_listings['rent'] / all_listings['sqft']
-        all_listings['date'] = pd.to_datetime(all_listings['date'], format='%Y-%m-%d')
-        all_listings['day_of_week'] = all_listings['date'].apply(lambda x: x.weekday())
-        all_listings['region'] = all_listings['url'].str.extract('http://(.*).craigslist.org', expand=False)
-        unique_listings = pd.DataFrame(all_listings.drop_duplicates(subset='pid', inplace=False))
-        thorough_listings = pd.DataFrame(unique_listings)
-        thorough_listings = thorough_listings[thorough_listings['rent'] > 0]
-        thorough_listings = thorough_listings[thorough_listings['sqft'] > 0]
-        if len(thorough_listings) == 0:
-            return [], 0, 0, 0
 
-        # print('{0} thorough listings'.format(len(thorough_listings)))
-        geolocated_filtered_listings = pd.DataFrame(thorough_listings)
-        geolocated_filtered_listings = geolocated_filtered_listings[pd.notnull(geolocated_filtered_listings['latitude'])]
-        geolocated_filtered_listings = geolocated_filtered_listings[pd.notnull(geolocated_filtered_listings['longitude'])]
-        cols = ['pid', 'date', 'region', 'neighborhood', 'rent', 'bedrooms', 'sqft', 'rent_sqft', 'bathrooms', 
-                'longitude', 'latitude']
-        data_output = geolocated_filtered_listings[cols]
+        with self.metrics.time('clean'):
+            data_output, count_listings, count_thorough = category.clean(all_listings)
+        if count_thorough == 0:
+            return [], 0, 0, 0
+        if not category.geocode:
+            return data_output, count_listings, count_thorough, len(data_output)
 
         # TO DO: exception handling for fips
-        fips = data_output.apply(self._get_fips, axis=1)             
+        with self.metrics.time('geocode'):
+            fips = self._geocode(data_output)
         geocoded = pd.concat([data_output, fips], axis=1)
 
         # print('{0} geocoded listings'.format(len(geocoded)))
-        return geocoded, len(all_listings), len(thorough_listings), len(geocoded)
-
-    def _write_db(self, dataframe, domain):
-        dbname = 'craigslist'
-        host='localhost'
-        port=5432
-        username='mgardner'
-        passwd='craig'
-        conn_str = "dbname={0} user={1} host={2} password={3} port={4}".format(dbname,username,host,passwd,port)
-        conn = psycopg2.connect(conn_str)
-        cur = conn.cursor()
-        num_listings = len(dataframe)
-        # print("Inserting {0} listings from {1} into database.".format(num_listings, domain))
-        prob_PIDs = []
-        dupes = []
-        writes = []
-        for i,row in dataframe.iterrows():
-            try:
-                cur.execute('''INSERT INTO rental_listings
-                            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)''',
-                                (row['pid'],row['date'].to_datetime(),row['region'],row['neighborhood'],
-                                row['rent'],row['bedrooms'],row['sqft'],row['rent_sqft'],
-                                row['longitude'],row['latitude'],row['county'],
-                                row['fips_block'],row['state'],row['bathrooms']))
-                conn.commit()
-                writes.append(row['pid'])
-            except Exception, e:
-                if 'duplicate key value violates unique' in str(e):
-                    dupes.append(row['pid'])
-                else:
-                    prob_PIDs.append(row['pid'])
-                conn.rollback()
-                
-        cur.close()
-        conn.close()
-        return prob_PIDs, dupes, writes
+        return geocoded, count_listings, count_thorough, len(geocoded)
+
+    def _db_conn(self):
+        '''
+        Returns the database connection, opening it the first time. One connection is
+        used for all the domains in a run.
+        '''
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(DB_CONN_STR)
+        return self._conn
+
+
+    def _write_db(self, dataframe, domain, category=None):
+        '''
+        Writes cleaned listings to the database, skipping pids that are already there.
+        Uses a bulk load unless db_bulk is False. Returns lists of problem, duplicate
+        and written pids.
+        '''
+        table, columns = DB_TABLE, DB_COLUMNS
+        if category is not None and category.table is not None:
+            table, columns = category.table, category.db_columns
+        rows = list(dataframe[columns].itertuples(index=False))
+        load = dbload.bulk_insert if self.db_bulk else dbload.insert_rows
+        return load(self._db_conn(), table, rows, list(dataframe['pid']))
     
-    def run(self, charity_proxy=True):
+    def _load_listings(self, all_listings, domain, totals, category=None):
+        '''
+        Cleans a DataFrame of scraped rows and writes them to the database, adding the
+        counts to totals for the region.
+        '''
+        cleaned, count_listings, count_thorough, count_geocoded = self._clean_frame(all_listings, category)
+        totals['listings'] += count_listings
+        totals['thorough'] += count_thorough
+        totals['geocoded'] += count_geocoded
+        totals['cleaned'] += len(cleaned)
+
+        if len(cleaned) > 0:
+            with self.metrics.time('db_write'):
+                probs, dupes, writes = self._write_db(cleaned, domain, category)
+            self.metrics.count('rows_written', len(writes))
+            totals['probs'].extend(probs)
+            totals['dupes'] += len(dupes)
+            totals['writes'] += len(writes)
+
+    def _searches(self):
+        '''
+        Returns (search url, category) for each category to crawl in each domain.
+        '''
+        searches = []
+        for domain in self.domains:
+            for code in self.categories or [categories.domain_category(domain)]:
+                searches.append((categories.search_url(domain, code), categories.get_category(code)))
+        return searches
+
+    def run(self, charity_proxy=True, profile=None):
+        '''
+        Crawls the domains. With profile, a directory, the run is profiled and the
+        results saved there, to be combined with those of other runs by profiling.merge.
+        See profiling.py.
+        '''
+        if profile is not None:
+            self._profiler = profiling.Profiler(profile)
+            self._profiler.start()
+
+        # Closed here so that its threads don't outlive a run that raises or is interrupted
+        self._pool = ThreadPool(self.detail_workers) if self.detail_workers > 1 else None
+        try:
+            return self._run(charity_proxy)
+        except BaseException:
+            if self._pool is not None:
+                self._pool.terminate()  # don't wait for the pages still queued
+            raise
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+            if self._profiler is not None:
+                self._profiler.stop()
+                self._profiler = None
+
+    def _run(self, charity_proxy):
     
-        colnames = ['pid','dt','url','title','price','neighb','beds','sqft', 'baths',
-                        'lat','lng','accuracy','address']
         st_time = time.time()
+        stats = []
+
+        # One pooled session for Craigslist and one for the FCC API, kept for the whole run.
+        # Craigslist requests are paced by a rate limiter shared with the other processes.
+        limiter = None
+        if self.rate_limit:
+            limiter = ratelimit.RateLimiter(self.rate_limit_file, rate=self.rate_limit,
+                                            host_rate=self.host_rate_limit)
+        self._retry = retry.RetryPolicy(retries=self.retries)
+        s = sessions.make_session(charity_proxy, pool_maxsize=self.pool_maxsize,
+                                  dns_ttl=self.dns_ttl, limiter=limiter, retry=self._retry)
+        self._fips_session = sessions.make_session(False, dns_ttl=self.dns_ttl)
+
+        if self.cache_dir is not None:
+            self._cache = pagecache.PageCache(self.cache_dir, ttl=self.cache_ttl)
+
+        if self.geocoder_dir is not None:
+            self._geocoder = geocoder.BlockGeocoder(self.geocoder_dir)
+
+        if self.fips_cache is not None:
+            self._fips_cache = fipscache.FipsCache(self.fips_cache)
 
-        # Loop over each regional Craigslist URL
-        for i, domain in enumerate(self.domains):
+        if self.checkpoint_dir is not None:
+            self._checkpoints = checkpoint.Checkpoints(self.checkpoint_dir)
+
+        # Posting ids already stored, plus the ones we come across during this run
+        self._seen = seenpids.SeenPids(self.seen_pids)
+
+        # Failed requests in a row, per region
+        breakers = {}
+
+        # Loop over each regional Craigslist URL, and each category in it
+        for i, (domain, category) in enumerate(self._searches()):
+
+            colnames = category.colnames
+            stream = self.stream and category.load  # only listings that are loaded are streamed
 
             total_listings = 0
+            in_window = 0  # distinct listings posted between earliest_ts and latest_ts
+            window_pids = set()
             listing_num = 0
             ts_skipped = 0
+            seen_skipped = 0
+            filtered = 0
+            resume_skipped = 0
+            resume_ts = None  # listings newer than this were handled before an interruption
+            failed_pids = []  # listings whose pages couldn't be fetched, not skipped on resume
+            item_ts = None
 
             regionName = domain.split('//')[1].split('.craigslist')[0]
+            self.metrics.region = regionName
+            if self._profiler is not None:
+                self._profiler.region = regionName
+            domain_stats = {'domain': domain, 'region': regionName, 'category': category.code,
+                            'listings': 0, 'rows': 0, 'cleaned': 0, 'written': 0, 'dupes': 0}
+            stats.append(domain_stats)
+            domain_st_time = time.time()
+
+            breaker = breakers.setdefault(
+                regionName, retry.CircuitBreaker(self.domain_failures, regionName))
+            self._retry.breaker = breaker
+            if breaker.is_open:
+                logging.info('SKIPPING {0} AFTER TOO MANY FAILED REQUESTS'.format(str.upper(regionName)))
+                domain_stats['aborted'] = 'too many failed requests'
+                continue
             regionIsComplete = False
             search_url = domain
             logging.info('BEGINNING NEW REGION')
 
-            fname = self.out_dir + regionName + '-' \
-                + (self.ts if self.fname_ts else '') + '.csv'
-
-            with open(fname, 'wb') as f:
-                writer = csv.writer(f)
-                writer.writerow(colnames)
-
-                while not regionIsComplete:
-
-                    logging.info(search_url)
-                    s = requests.Session()
-
-                    if charity_proxy:
-                        requests.packages.urllib3.disable_warnings()
-                        authenticator = '87783015bbe2d2f900e2f8be352c414a'
-                        proxy_str = 'http://' + authenticator + '@' +'workdistribute.charityengine.com:20000'
-                        s.proxies = {'http': proxy_str, 'https': proxy_str}
-                        s.auth = HTTPProxyAuth(authenticator,'')
-
+            shard_label = shards.label(domain)
+            fname = self.out_dir + regionName + ('-' + shard_label if shard_label else '') + '-' \
+                + ('' if category.code == categories.DEFAULT_CATEGORY else category.code + '-') \
+                + (self.ts if self.fname_ts else '') + sinks.FORMATS[self.out_format]
+            chains = []  # first pages of shards still to crawl, if the search was capped
+            chain_root = domain  # first page of the search or shard being crawled
+
+            batch = []  # scraped rows waiting to be cleaned, in streaming mode
+            totals = {'listings': 0, 'thorough': 0, 'geocoded': 0, 'cleaned': 0,
+                      'probs': [], 'dupes': 0, 'writes': 0}
+
+            # Continue from where an interrupted run with the same file and time window
+            # stopped, if there's a checkpoint for it
+            run_id = '{0} {1} {2}'.format(fname, self.earliest_ts, self.latest_ts)
+            state = None
+            if self.resume and self._checkpoints is not None:
+                state = self._checkpoints.load(domain, run_id)
+
+            if state is not None and not state['crawled'] and not stream \
+                    and self.out_format != 'csv':
+                logging.info('CANNOT APPEND TO {0}, RESTARTING {1}'.format(fname, str.upper(regionName)))
+                state = None
+
+            if state is not None:
+                if state['done']:
+                    logging.info('{0} WAS ALREADY FINISHED'.format(str.upper(regionName)))
+                    domain_stats.update(state['stats'])
+                    continue
+
+                logging.info('RESUMING {0} AT {1}'.format(str.upper(regionName), state['search_url']))
+                search_url = state['search_url']
+                chains = state.get('chains', [])
+                chain_root = state.get('chain_root', domain)
+                regionIsComplete = state['crawled']
+                total_listings = state['total_listings']
+                listing_num = state['listing_num']
+                ts_skipped = state['ts_skipped']
+                in_window = state.get('in_window', 0)
+                seen_skipped = state['seen_skipped']
+                filtered = state['filtered']
+                domain_stats['rows'] = state['rows']
+                totals = state['totals']
+                failed_pids = state.get('failed_pids', [])
+                window_pids = set(state.get('window_pids', []))
+                for pid in window_pids:
+                    # Handled before the interruption, so skipped when a shard lists it again
+                    if pid not in failed_pids:
+                        self._seen.add(pid)
+                if state['last_ts'] is not None:
+                    resume_ts = resultparser.parse_timestamp(state['last_ts'])
+
+            last_ts = state['last_ts'] if state is not None else None
+
+            def save_checkpoint(crawled=False, done=False):
+                if self._checkpoints is not None:
+                    self._checkpoints.save(domain, run_id, dict(
+                        search_url=search_url, chains=chains, chain_root=chain_root, crawled=crawled, done=done, last_ts=last_ts,
+                        total_listings=total_listings, in_window=in_window,
+                        window_pids=sorted(window_pids), listing_num=listing_num,
+                        ts_skipped=ts_skipped, seen_skipped=seen_skipped, filtered=filtered,
+                        rows=domain_stats['rows'], totals=totals, failed_pids=failed_pids,
+                        stats=domain_stats))
+
+            def finish_region():
+                if 'aborted' in domain_stats:
+                    # Not marked as done, so that the next crawl picks up from here
+                    logging.warning('STOPPED {0} EARLY: {1}'.format(str.upper(regionName), domain_stats['aborted']),
+                                    extra=logqueue.event('region_summary', **domain_stats))
+                    return
+                save_checkpoint(crawled=True, done=True)
+                logging.info('FINISHED {0}'.format(str.upper(regionName)),
+                             extra=logqueue.event('region_summary', **domain_stats))
+
+            # Rows go to a data file, which is read back for cleaning, unless they're
+            # streamed to the database as they are scraped and save_file is off
+            writer = None
+            if (self.save_file or not stream) and not regionIsComplete:
+                writer = sinks.open_sink(self.out_format, fname, colnames, category.schema,
+                                         region=regionName,
+                                         append=state is not None and self.out_format == 'csv')
+
+            while not regionIsComplete:
+
+                logging.info(search_url)
+
+                # Retries happen in the session, so a failure here is final
+                page = None
+                with self.metrics.time('search_fetch'):
                     try:
                         page = s.get(search_url, timeout=30)
-                    except requests.exceptions.Timeout:
-                        s = requests.Session()
-                        if charity_proxy:
-                            s.proxies = {'http': proxy_str, 'https': proxy_str}
-                            s.auth = HTTPProxyAuth(authenticator,'')
-                        try:
-                            page = s.get(search_url, timeout=30)    
-                        except:
-                            regionIsComplete = True
-                            logging.info('FAILED TO CONNECT.')
+                    except Exception as e:
+                        domain_stats['aborted'] = '{0}: {1}'.format(type(e).__name__, e)
+                        logging.info('FAILED TO CONNECT. ' + domain_stats['aborted'])
+                        self.metrics.count('search_errors')
 
+                if page is not None:
                     try:
-                        tree = html.fromstring(page.content)
-                    except:
-                        regionIsComplete = True
+                        with self.metrics.time('search_parse'):
+                            tree = html.fromstring(page.content)
+                    except Exception:
+                        domain_stats['aborted'] = 'unreadable search page'
                         logging.info('FAILED TO PARSE HTML.')
+                        self.metrics.count('search_errors')
+
+                if 'aborted' in domain_stats:
+                    break
 
-                    listings = tree.xpath('//li[@class="result-row"]')
+                listings = resultparser.RESULT_ROWS(tree)
 
-                    ### TO DO: Need better way to check for HTML changes in Craigslist 
-                    if len(listings) == 0 and total_listings == 0:
-                        logging.info('NO LISTINGS RETRIEVED FOR {0}'.format(str.upper(regionName)))
+                ### TO DO: Need better way to check for HTML changes in Craigslist 
+                if len(listings) == 0 and total_listings == 0:
+                    logging.info('NO LISTINGS RETRIEVED FOR {0}'.format(str.upper(regionName)))
 
-                    total_listings += len(listings)
+                total_listings += len(listings)
+                self.metrics.count('search_pages')
                     
+                pending = []  # rows that still need their listing page scraped
 
-                    for item in listings:
+                for item in listings:
 
-                        listing_num += 1
-                        try:
-                            row = self._parseListing(item)
-                            item_ts = dt.strptime(row[1], '%Y-%m-%d %H:%M')
+                    listing_num += 1
+                    try:
+                        row = category.parse_row(item)
+                        item_ts = resultparser.parse_timestamp(row[1])
                 
-                            if (item_ts > self.latest_ts):
-                                # Skip this item but continue parsing search results
-                                ts_skipped += 1
-                                continue
-
-                            if (item_ts < self.earliest_ts):
-                                # Break out of loop and move on to the next region
-                                if listing_num == 1:
-                                    logging.info('NO LISTINGS BEFORE TIMESTAMP CUTOFF AT {0}'.format(str.upper(regionName)))    
-                                else:
-                                    logging.info('REACHED TIMESTAMP CUTOFF')
-                                ts_skipped += 1
-                                regionIsComplete = True
-                                break 
-                    
-                            item_url = domain.split('/search')[0] + row[2]
-                            row[2] = item_url
+                        if (item_ts > self.latest_ts):
+                            # Skip this item but continue parsing search results
+                            ts_skipped += 1
+                            continue
 
-                            # Parse listing page to get lat-lng
-                            logging.info(item_url)
-                            row += self._scrapeLatLng(s, item_url)
-                            writer.writerow(row)
+                        if (item_ts < self.earliest_ts):
+                            # Break out of loop and move on to the next region
+                            if listing_num == 1:
+                                logging.info('NO LISTINGS BEFORE TIMESTAMP CUTOFF AT {0}'.format(str.upper(regionName)))    
+                            else:
+                                logging.info('REACHED TIMESTAMP CUTOFF')
+                            ts_skipped += 1
+                            regionIsComplete = True
+                            break 
 
-                        except Exception, e:
-                            # Skip listing if there are problems parsing it
-                            logging.warning("{0}: {1}. Probably no beds/sqft info".format(type(e).__name__, e))
+                        if resume_ts is not None and item_ts > resume_ts and row[0] not in failed_pids:
+                            # Handled before the interruption, and pushed down by newer listings
+                            resume_skipped += 1
                             continue
+                        last_ts = row[1]
+
+                        if row[0] not in window_pids:
+                            # Not counted again when a later page or shard lists it again
+                            window_pids.add(row[0])
+                            in_window += 1
+                            self.metrics.count('listings')
                     
-                    next = tree.xpath('//a[@title="next page"]/@href')
-                    if len(next) > 0:
-                        search_url = domain.split('/search')[0] + next[0]
+                        if not self._seen.add(row[0]):
+                            # Already stored, or listed again on a later results page
+                            seen_skipped += 1
+                            continue
+
+                        if category.prefetch_filter and self.prefetch_filter and self.prefetch_filter.reject(
+                                dict(zip(colnames, row))) is not None:
+                            # Missing something we need, so not worth a request
+                            filtered += 1
+                            continue
+
+                        item_url = domain.split('/search')[0] + row[2]
+                        row[2] = item_url
+                        pending.append(row)
+
+                    except Exception, e:
+                        # Skip listing if there are problems parsing it
+                        logging.warning("{0}: {1}. Probably no beds/sqft info".format(type(e).__name__, e))
+                        continue
+
+                # Parse listing pages to get lat-lng, and write rows in search order
+                try:
+                    details = self._fetch_details(s, pending, category)
+                except retry.CircuitOpen as e:
+                    domain_stats['aborted'] = str(e)
+                    for row in pending:
+                        self._seen.discard(row[0])
+                    break
+                for row, detail in zip(pending, details):
+                    if detail is None:
+                        # Tried again if it comes up in a later shard or a resumed run
+                        self._seen.discard(row[0])
+                        failed_pids.append(row[0])
+                    else:
+                        if writer is not None:
+                            writer.writerow(row + detail)
+                        if stream:
+                            batch.append(row + detail)
+                        domain_stats['rows'] += 1
+                        self.metrics.count('rows')
+
+                if len(batch) >= self.stream_batch:
+                    self._load_listings(self._frame(batch, colnames), domain, totals, category)
+                    batch = []
+                    
+                next = resultparser.NEXT_PAGE(tree)
+                if len(next) > 0:
+                    search_url = domain.split('/search')[0] + next[0]
+                else:
+                    # Out of results before the time cutoff. If the search stopped at the
+                    # cap, the rest of the window is only reachable through its shards.
+                    parts = []
+                    if self.shard and not regionIsComplete and shards.is_capped(search_url, len(listings)):
+                        parts = shards.split(chain_root)
+                    if len(parts) > 0:
+                        logging.info('SPLITTING {0} INTO {1} SHARDS'.format(chain_root, len(parts)))
+                        if chain_root == domain:
+                            domain_stats['shards'] = parts
+                        chains = parts + chains
                     else:
-                        regionIsComplete = True
                         logging.info('RECEIVED ERROR PAGE')
-
-                    s.close()
-            
-            # print ts_skipped
+                    regionIsComplete = True
+
+                if regionIsComplete and len(chains) > 0:
+                    # On to the next shard, which starts again from the newest listings
+                    search_url = chains.pop(0)
+                    chain_root = search_url
+                    regionIsComplete = False
+                    resume_ts = None
+                    last_ts = None
+
+                # Everything up to here is in the data file or the database
+                if len(batch) == 0:
+                    if writer is not None:
+                        writer.flush()
+                    save_checkpoint()
+
+            if stream and len(batch) > 0:
+                self._load_listings(self._frame(batch, colnames), domain, totals, category)
+                batch = []
+
+            if writer is not None:
+                writer.close()
+            if 'aborted' not in domain_stats:
+                save_checkpoint(crawled=True)
+
+            domain_stats['listings'] = in_window
+            domain_stats['seen'] = seen_skipped
+            domain_stats['filtered'] = filtered
+            if seen_skipped > 0:
+                logging.info('SKIPPED {0} LISTINGS ALREADY SEEN IN {1}'.format(seen_skipped, str.upper(regionName)))
+            if filtered > 0:
+                logging.info('SKIPPED {0} LISTINGS IN {1} THAT FAILED THE PREFETCH FILTER'.format(filtered, str.upper(regionName)))
+            if resume_skipped > 0:
+                logging.info('SKIPPED {0} LISTINGS IN {1} HANDLED BEFORE RESUMING'.format(resume_skipped, str.upper(regionName)))
+            domain_stats['seconds'] = time.time() - domain_st_time
+
+            if 'aborted' in domain_stats and self.resume and self._checkpoints is not None:
+                # Not loaded yet. The next run with the same data file and time window
+                # resumes the region from its checkpoint and loads the whole file. Without
+                # resume, what was scraped is loaded now, since nothing would pick it up.
+                finish_region()
+                continue
 
             if ts_skipped == total_listings:
-                logging.info(('{0} TIMESTAMPS NOT MATCHING' +
-                             ' - CL: {1} vs. UAL: {2}.' +
-                             ' NO DATA SAVED.').format(
-                                 regionName,
-                                 str(item_ts),
-                                 str(self.latest_ts)))
+                if 'aborted' not in domain_stats:
+                    logging.info(('{0} TIMESTAMPS NOT MATCHING' +
+                                 ' - CL: {1} vs. UAL: {2}.' +
+                                 ' NO DATA SAVED.').format(
+                                     regionName,
+                                     str(item_ts),
+                                     str(self.latest_ts)))
+                finish_region()
                 continue
 
+            if not category.load:
+                # Only saved to the data file
+                finish_region()
+                continue
 
-            cleaned, count_listings, count_thorough, count_geocoded = self._clean_listings(fname)
-            num_cleaned = len(cleaned)
+            if not stream:
+                self._load_listings(self._read_listings(fname, category), domain, totals, category)
+
+            num_cleaned = totals['cleaned']
+            count_listings = totals['listings']
+            count_thorough = totals['thorough']
+            count_geocoded = totals['geocoded']
 
             if num_cleaned > 0:
-                probs, dupes, writes = self._write_db(cleaned, domain)
+                probs = totals['probs']
                 num_probs = len(probs)
-                num_dupes = len(dupes)
-                num_writes = len(writes)
+                num_dupes = totals['dupes']
+                num_writes = totals['writes']
+                domain_stats.update(cleaned=num_cleaned, written=num_writes, dupes=num_dupes)
                 assert num_probs + num_dupes + num_writes == num_cleaned 
                 pct_written = (num_writes) / num_cleaned * 100
                 pct_fail = round(num_probs / num_cleaned * 100,3)
@@ -418,15 +810,23 @@ class RentalListingScraper(object):
                              ' {0} scraped, {1} w/ rent/sqft, {2} w/ lat/lon.'.format(
                                 count_listings, count_thorough, count_geocoded))
 
-        return
-
-
-
-
-
+            domain_stats['seconds'] = time.time() - domain_st_time
+            finish_region()
 
+        s.close()
+        self._fips_session.close()
 
+        if self._conn is not None:
+            self._conn.close()
 
+        if self._cache is not None:
+            logging.info('PAGE CACHE: {0} HITS, {1} MISSES'.format(self._cache.hits, self._cache.misses))
 
+        if self._fips_cache is not None:
+            logging.info('FIPS CACHE: {0} HITS, {1} MISSES'.format(self._fips_cache.hits, self._fips_cache.misses))
+            self._fips_cache.close()
 
+        if self.metrics_file is not None:
+            self.metrics.write(self.metrics_file)
 
+        return stats
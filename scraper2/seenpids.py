@@ -0,0 +1,94 @@
+import glob
+import logging
+import os
+import threading
+import numpy as np
+import pandas as pd
+import sinks
+
+
+def build_index(fname, conn_str=None, table=None, csv_pattern=None):
+    '''
+    Collects the posting ids we already have, from a database table and/or the CSV
+    or Parquet files matching csv_pattern, and saves them to fname as a sorted numpy array.
+    Returns the number of ids in the index.
+    '''
+    chunks = [np.zeros(0, dtype=np.int64)]
+
+    if conn_str is not None and table is not None:
+        import psycopg2
+        conn = psycopg2.connect(conn_str)
+        cur = conn.cursor('seen_pids')  # server-side cursor, so rows arrive in batches
+        cur.itersize = 100000
+        cur.execute('SELECT pid FROM {0}'.format(table))
+        chunks.append(np.fromiter((int(row[0]) for row in cur), dtype=np.int64))
+        cur.close()
+        conn.close()
+
+    if csv_pattern is not None:
+        for csv_fname in glob.glob(csv_pattern):
+            try:
+                pids = sinks.read_file(csv_fname, columns=['pid'])['pid']
+            except Exception as e:
+                logging.warning('Could not read pids from {0}: {1}'.format(csv_fname, e))
+                continue
+            pids = pd.to_numeric(pids, errors='coerce').dropna()
+            chunks.append(pids.values.astype(np.int64))
+
+    pids = np.unique(np.concatenate(chunks))
+
+    # Write to a temporary file first, so running scrapers never see half an index
+    tmp_fname = fname + '.tmp.npy'
+    np.save(tmp_fname, pids)
+    os.rename(tmp_fname, fname)
+    return len(pids)
+
+
+class SeenPids(object):
+    '''
+    Set-like index of posting ids that don't need to be scraped again. The ids saved by
+    build_index() are memory-mapped, so worker processes share one copy through the
+    page cache, and ids added during a run are kept in an ordinary set.
+    '''
+
+    def __init__(self, fname=None):
+
+        self.stored = np.zeros(0, dtype=np.int64)
+        if fname is not None and os.path.exists(fname):
+            self.stored = np.load(fname, mmap_mode='r')
+        self.added = set()
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, pid):
+
+        pid = int(pid)
+        if pid in self.added:
+            return True
+
+        i = np.searchsorted(self.stored, pid)
+        return i < len(self.stored) and self.stored[i] == pid
+
+
+    def __len__(self):
+        return len(self.stored) + len(self.added)
+
+
+    def add(self, pid):
+        '''
+        Adds pid and returns True, or returns False if it was already there.
+        '''
+        with self._lock:
+            if pid in self:
+                return False
+            self.added.add(int(pid))
+            return True
+
+
+    def discard(self, pid):
+        '''
+        Takes back a pid added during the run, for example when its page couldn't be
+        fetched, so that it's tried again if it comes up later.
+        '''
+        with self._lock:
+            self.added.discard(int(pid))
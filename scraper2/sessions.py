@@ -0,0 +1,132 @@
+import socket
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPProxyAuth
+
+# Requests go through the Charity Engine proxy by default
+CHARITY_AUTHENTICATOR = '87783015bbe2d2f900e2f8be352c414a'
+CHARITY_PROXY = 'http://' + CHARITY_AUTHENTICATOR + '@' + 'workdistribute.charityengine.com:20000'
+
+# Connection pool settings. Connections are kept alive and reused for the whole run,
+# so we only pay for the TCP and proxy handshakes once per connection.
+POOL_CONNECTIONS = 10  # number of hosts to keep a pool for
+POOL_MAXSIZE = 16  # connections kept open per host
+DNS_TTL = 300  # seconds to cache DNS lookups, or 0 to disable
+
+# Only lookups of these hosts and their subdomains are cached, which covers Craigslist
+# and the proxy. Anything else, like the FCC API, is resolved as usual. At most
+# DNS_CACHE_SIZE lookups are kept.
+DNS_HOSTS = ('craigslist.org', 'charityengine.com')
+DNS_CACHE_SIZE = 1000
+
+_dns_cache = {}
+_dns_lock = threading.Lock()
+_getaddrinfo = socket.getaddrinfo
+
+
+def _cached_getaddrinfo(*args, **kwargs):
+    '''
+    Drop-in replacement for socket.getaddrinfo that remembers results for DNS_TTL
+    seconds, so that new connections to the same host skip the lookup. Only hosts in
+    DNS_HOSTS are cached.
+    '''
+    host = args[0] if len(args) > 0 else kwargs.get('host')
+    if not isinstance(host, (type(''), type(u''))) or not any(
+            host == name or host.endswith('.' + name) for name in DNS_HOSTS):
+        return _getaddrinfo(*args, **kwargs)
+
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.time()
+
+    with _dns_lock:
+        cached = _dns_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    result = _getaddrinfo(*args, **kwargs)
+    with _dns_lock:
+        if len(_dns_cache) >= DNS_CACHE_SIZE:
+            for k in [k for k, v in _dns_cache.items() if v[0] <= now]:
+                del _dns_cache[k]
+            if len(_dns_cache) >= DNS_CACHE_SIZE:
+                _dns_cache.clear()
+        _dns_cache[key] = (now + DNS_TTL, result)
+    return result
+
+
+def enable_dns_cache(ttl=DNS_TTL):
+    '''
+    Turns on DNS caching for the whole process. This replaces socket.getaddrinfo, so
+    it changes how every library in the process resolves names, but only for the hosts
+    in DNS_HOSTS. Libraries that resolve names in C, like psycopg2, aren't affected.
+    '''
+    global DNS_TTL
+    DNS_TTL = ttl
+    if ttl > 0:
+        socket.getaddrinfo = _cached_getaddrinfo
+    else:
+        socket.getaddrinfo = _getaddrinfo
+        with _dns_lock:
+            _dns_cache.clear()
+
+
+class LimitedSession(requests.Session):
+    '''
+    Session that waits for the rate limiter before each request and reports each
+    response back to it, so that every fetch path is paced without having to know
+    about the limiter. With a RetryPolicy, failed requests are also retried, each
+    attempt going through the limiter. See retry.py.
+    '''
+
+    limiter = None
+    retry = None
+
+    def request(self, method, url, *args, **kwargs):
+
+        if self.retry is None:
+            return self._request(method, url, *args, **kwargs)
+        return self.retry.call(lambda: self._request(method, url, *args, **kwargs), url)
+
+    def _request(self, method, url, *args, **kwargs):
+
+        if self.limiter is None:
+            return super(LimitedSession, self).request(method, url, *args, **kwargs)
+
+        self.limiter.wait(url)
+        response = super(LimitedSession, self).request(method, url, *args, **kwargs)
+        self.limiter.update(url, response)
+        return response
+
+
+def make_session(
+        charity_proxy = True,
+        proxy_str = CHARITY_PROXY,
+        pool_connections = POOL_CONNECTIONS,
+        pool_maxsize = POOL_MAXSIZE,
+        dns_ttl = DNS_TTL,
+        verify = True,
+        limiter = None,
+        retry = None):
+    '''
+    Returns a requests Session with a keep-alive connection pool sized for concurrent
+    use, and optionally set up to go through the proxy, a RateLimiter and a
+    RetryPolicy. One session is meant to be shared by all the requests a scraper makes
+    during a run.
+    '''
+    s = LimitedSession()
+    s.limiter = limiter
+    s.retry = retry
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.verify = verify
+
+    if charity_proxy:
+        requests.packages.urllib3.disable_warnings()
+        s.proxies = {'http': proxy_str, 'https': proxy_str}
+        s.auth = HTTPProxyAuth(CHARITY_AUTHENTICATOR, '')
+
+    enable_dns_cache(dns_ttl)
+    return s
@@ -0,0 +1,116 @@
+try:
+    from urlparse import urlsplit, urlunsplit, parse_qsl
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Craigslist stops returning results after this many, however many listings match
+RESULT_CAP = 2500
+
+# Sub-areas of the regions that can hit the cap, as they appear in listing urls
+# like /sfc/apa/123.html. A search can be limited to one with /search/sfc/apa.
+SUBAREAS = {
+    'sfbay': ['sfc', 'sby', 'eby', 'pen', 'nby', 'scz'],
+    'losangeles': ['wst', 'sfv', 'lac', 'sgv', 'lgb', 'ant'],
+    'newyork': ['mnh', 'brk', 'que', 'brx', 'stn', 'jsy', 'lgi', 'wch', 'fct'],
+    'chicago': ['chc', 'nch', 'wcl', 'sox', 'nwi', 'nwc'],
+    'seattle': ['see', 'est', 'sno', 'kit', 'tac', 'oly', 'skc'],
+    'washingtondc': ['doc', 'nva', 'mld'],
+    'boston': ['gbs', 'nwb', 'bmw', 'nos', 'sob'],
+    'sandiego': ['csd', 'nsd', 'esd', 'ssd'],
+    'denver': ['den', 'dnc'],
+    'portland': ['mlt', 'wsc', 'clc', 'yam', 'clk', 'grg']}
+
+# Monthly rent bands for splitting searches that are still capped within a sub-area.
+# The last band has no upper limit. Bands that are still capped are halved, down to
+# MIN_BAND dollars wide. Listings without a price don't show up in any band.
+PRICE_BANDS = [0, 1000, 1500, 2000, 2500, 3000, 4000, 6000]
+MIN_BAND = 100
+
+
+def _parts(url):
+    '''
+    Splits a search url into its pieces: (scheme, host, region, subarea, category,
+    query dict). subarea is None for a search of the whole region, and category is
+    None if url isn't a search.
+    '''
+    scheme, host, path, query, fragment = urlsplit(url)
+    region = host.split('.')[0]
+    path = [p for p in path.split('/') if p]  # ['search', 'sfc', 'apa'] or ['search', 'apa']
+    subarea = path[1] if len(path) > 2 else None
+    category = path[-1] if len(path) > 1 and path[0] == 'search' else None
+    return scheme, host, region, subarea, category, dict(parse_qsl(query))
+
+
+def _url(scheme, host, subarea, category, query):
+    path = '/search/' + (subarea + '/' if subarea else '') + category
+    query = dict((k, v) for k, v in query.items() if k != 's')  # start at the first page
+    return urlunsplit((scheme, host, path, urlencode(sorted(query.items())), ''))
+
+
+def _price_bands(low, high):
+    '''
+    Returns narrower (low, high) bands covering low to high, where high may be None.
+    '''
+    if low is None and high is None:
+        bounds = PRICE_BANDS + [None]
+        return [(bounds[i], bounds[i + 1] - 1 if bounds[i + 1] is not None else None)
+                for i in range(len(PRICE_BANDS))]
+
+    low = low or 0
+    if high is None:
+        split = max(low * 2, low + MIN_BAND)
+        return [(low, split - 1), (split, None)]
+    if high - low + 1 < 2 * MIN_BAND:
+        return []
+    middle = (low + high + 1) // 2
+    return [(low, middle - 1), (middle, high)]
+
+
+def split(url):
+    '''
+    Returns search urls that together cover the same listings as url, splitting a
+    region into its sub-areas first and then into price bands. Returns an empty list
+    if url can't be split any further.
+    '''
+    scheme, host, region, subarea, category, query = _parts(url)
+    if category is None:
+        return []
+
+    if subarea is None and region in SUBAREAS:
+        return [_url(scheme, host, s, category, query) for s in SUBAREAS[region]]
+
+    low = int(query['min_price']) if query.get('min_price', '').isdigit() else None
+    high = int(query['max_price']) if query.get('max_price', '').isdigit() else None
+    shards = []
+    for band_low, band_high in _price_bands(low, high):
+        band = dict(query, min_price=str(band_low))
+        band.pop('max_price', None)
+        if band_high is not None:
+            band['max_price'] = str(band_high)
+        shards.append(_url(scheme, host, subarea, category, band))
+    return shards
+
+
+def label(url):
+    '''
+    Short name for a shard, for file names: '' for a whole region, and for example
+    'sfc' or 'sfc-1000-1499' for shards.
+    '''
+    scheme, host, region, subarea, category, query = _parts(url)
+    parts = [subarea] if subarea else []
+    if 'min_price' in query or 'max_price' in query:
+        parts.append(query.get('min_price', '0'))
+        parts.append(query.get('max_price', 'up'))
+    return '-'.join(parts)
+
+
+def is_capped(url, rows):
+    '''
+    Checks whether the last page of a search, at url with rows results on it, ends at
+    the result cap, so that older results couldn't be reached. Craigslist's total
+    count of a search isn't used, since it covers every active listing and not just
+    the ones in the time window being crawled.
+    '''
+    offset = _parts(url)[5].get('s', '0')
+    return offset.isdigit() and int(offset) + rows >= RESULT_CAP
@@ -0,0 +1,255 @@
+import os
+import unicodecsv as csv
+import pandas as pd
+import resultparser
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None  # only needed for the parquet format
+
+# Formats for the regional data files, and their file extensions
+FORMATS = {'csv': '.csv', 'parquet': '.parquet'}
+
+# Parquet settings. Rows are buffered and written ROW_GROUP_SIZE at a time. Columns
+# with few distinct values are dictionary-encoded, the others are stored plain.
+COMPRESSION = 'snappy'
+ROW_GROUP_SIZE = 10000
+DICTIONARY_COLUMNS = ['region', 'neighb']
+
+# Column types of the rows written by the scrapers, in the same order as their colnames.
+# Parquet files also get a region column.
+APA_SCHEMA = [
+    ('pid', 'int64'), ('dt', 'timestamp'), ('url', 'string'), ('title', 'string'),
+    ('price', 'float64'), ('neighb', 'string'), ('beds', 'float64'), ('sqft', 'float64'),
+    ('baths', 'float64'), ('lat', 'float64'), ('lng', 'float64'), ('accuracy', 'int32'),
+    ('address', 'string')]
+
+ROO_SCHEMA = [
+    ('pid', 'int64'), ('dt', 'timestamp'), ('url', 'string'), ('title', 'string'),
+    ('price', 'float64'), ('neighb', 'string'), ('sqft', 'float64'), ('lat', 'float64'),
+    ('lng', 'float64'), ('accuracy', 'int32'), ('body_text', 'string'), ('furnished', 'bool'),
+    ('laundry_known', 'bool'), ('laundry_onpremises', 'bool'), ('laundry_inunit', 'bool'),
+    ('room_known', 'bool'), ('private_room', 'bool'), ('bath_known', 'bool'),
+    ('private_bath', 'bool'), ('parking_known', 'bool'), ('onsite_parking', 'bool')]
+
+_text_type = type(u'')
+
+
+def _number(value, kind):
+    if value is None:
+        return None
+    try:
+        return kind(str(value).strip())
+    except (ValueError, UnicodeError):
+        pass
+    try:
+        return kind(float(value))  # for example '2.0' in an integer column
+    except (TypeError, ValueError, OverflowError, UnicodeError):
+        return None
+
+
+def _text(value):
+    if value is None or isinstance(value, _text_type):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return _text_type(value)
+
+
+def _flag(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().upper()
+    return True if value == 'TRUE' else False if value == 'FALSE' else None
+
+
+def _timestamp(value):
+    try:
+        return resultparser.parse_timestamp(value)
+    except (TypeError, ValueError):
+        return None
+
+
+_CONVERTERS = {
+    'int64': lambda v: _number(v, int),
+    'int32': lambda v: _number(v, int),
+    'float64': lambda v: _number(v, float),
+    'string': _text,
+    'bool': _flag,
+    'timestamp': _timestamp}
+
+
+class CsvSink(object):
+    '''
+    Writes rows to a CSV file, as the scrapers always have. With append, rows are
+    added to the end of an existing file.
+    '''
+
+    def __init__(self, fname, colnames, append=False):
+
+        self.fname = fname
+        append = append and os.path.exists(fname)
+        self._f = open(fname, 'ab' if append else 'wb')
+        self._writer = csv.writer(self._f)
+        if not append:
+            self._writer.writerow(colnames)
+
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+
+
+    def flush(self):
+        '''
+        Makes sure the rows so far are on disk.
+        '''
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+
+    def close(self):
+        self._f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParquetSink(object):
+    '''
+    Writes rows to a compressed Parquet file with a fixed schema, so that readers get
+    typed columns and can load only the columns they need. Values that don't fit a
+    column's type are stored as nulls. The file can't be read until it is closed, so it
+    can't be appended to after a crash either.
+    '''
+
+    def __init__(self, fname, colnames, schema, region=None,
+                 compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE):
+
+        if pa is None:
+            raise ImportError('Writing Parquet files needs pyarrow')
+        if [name for name, kind in schema] != list(colnames):
+            raise ValueError('Schema does not match the columns {0}'.format(', '.join(colnames)))
+
+        self.fname = fname
+        self.region = region
+        self.row_group_size = row_group_size
+        self._schema = schema
+        self._rows = []
+
+        types = {'int64': pa.int64(), 'int32': pa.int32(), 'float64': pa.float64(),
+                 'string': pa.string(), 'bool': pa.bool_(), 'timestamp': pa.timestamp('s')}
+        fields = [pa.field(name, types[kind]) for name, kind in schema]
+        fields.append(pa.field('region', pa.string()))
+        self._types = [field.type for field in fields]
+        self._arrow_schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(
+            fname, self._arrow_schema, compression=compression,
+            use_dictionary=[c for c in DICTIONARY_COLUMNS if c in self._arrow_schema.names])
+
+
+    def writerow(self, row):
+
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+
+
+    def _flush(self):
+
+        if len(self._rows) == 0:
+            return
+
+        arrays = []
+        for i, (name, kind) in enumerate(self._schema):
+            convert = _CONVERTERS[kind]
+            arrays.append(pa.array([convert(row[i]) for row in self._rows], type=self._types[i]))
+        arrays.append(pa.array([_text(self.region)] * len(self._rows), type=pa.string()))
+
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._arrow_schema))
+        self._rows = []
+
+
+    def flush(self):
+        self._flush()
+
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sink(out_format, fname, colnames, schema, region=None, append=False):
+    '''
+    Opens a CsvSink or ParquetSink for fname, which should end in FORMATS[out_format].
+    Only CSV files can be appended to.
+    '''
+    if out_format == 'csv':
+        return CsvSink(fname, colnames, append=append)
+    if append:
+        raise ValueError('Only CSV files can be appended to')
+    if out_format == 'parquet':
+        return ParquetSink(fname, colnames, schema, region=region)
+    raise ValueError('Unknown output format {0}, use one of {1}'.format(
+        out_format, ', '.join(sorted(FORMATS))))
+
+
+def _read_parquet(fname, columns=None):
+    '''
+    Reads a Parquet file into an Arrow table, leaving out requested columns that it
+    doesn't have.
+    '''
+    if pq is None:
+        raise ImportError('Reading Parquet files needs pyarrow')
+
+    parquet_file = pq.ParquetFile(fname, read_dictionary=DICTIONARY_COLUMNS)
+    if columns is not None:
+        names = parquet_file.schema.names
+        columns = [c for c in columns if c in names]
+    return parquet_file.read(columns=columns, use_threads=False)
+
+
+def read_file(fname, columns=None):
+    '''
+    Reads a regional data file in either format into a DataFrame, with only the given
+    columns if there are any. Parquet files come back with their stored types, and
+    dictionary-encoded columns as categoricals.
+    '''
+    if fname.endswith(FORMATS['parquet']):
+        return _read_parquet(fname, columns).to_pandas()
+
+    return pd.read_csv(fname, usecols=columns)
+
+
+def read_files(fnames, columns=None):
+    '''
+    Reads and concatenates several regional data files, for example a month of archives.
+    Parquet files with the same columns are combined before converting to a DataFrame,
+    which is much faster than converting them one by one.
+    '''
+    if len(fnames) == 0:
+        return pd.DataFrame(columns=columns)
+
+    if all(fname.endswith(FORMATS['parquet']) for fname in fnames):
+        tables = [_read_parquet(fname, columns) for fname in fnames]
+        try:
+            return pa.concat_tables(tables).to_pandas()
+        except pa.ArrowInvalid:
+            # Different columns, for example files from both scrapers
+            return pd.concat([t.to_pandas() for t in tables], ignore_index=True, sort=False)
+
+    return pd.concat([read_file(fname, columns) for fname in fnames], ignore_index=True, sort=False)
@@ -0,0 +1,88 @@
+# Resume tests for the scraper in scraper2/scraper2.py, against replay_server.py. Run with
+# python test_resume.py, or with pytest
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scraper2'))
+import pandas as pd
+import replay_server
+import scraper2
+import shards
+
+LISTINGS = 1000
+RESULT_CAP = 400  # low enough that sfbay is split into its sub-areas
+
+
+class OfflineScraper(scraper2.RentalListingScraper):
+    '''
+    Doesn't geocode or write to the database, and can be stopped after a number of
+    search pages, as if the process had been killed.
+    '''
+
+    crash_after = None
+
+    def _get_fips(self, row):
+        return pd.Series({'fips_block': '0', 'state': 'CA', 'county': 'X'})
+
+    def _write_db(self, dataframe, domain, category=None):
+        return [], [], list(dataframe['pid'])
+
+    def _fetch_details(self, session, rows, category):
+        if self.crash_after is not None:
+            self.crash_after -= 1
+            if self.crash_after < 0:
+                raise KeyboardInterrupt('stopped by the test')
+        return super(OfflineScraper, self)._fetch_details(session, rows, category)
+
+
+class ShardResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = replay_server.start(listings=LISTINGS, result_cap=RESULT_CAP)
+        self.env = dict(os.environ)
+        os.environ['HTTP_PROXY'] = os.environ['http_proxy'] = self.server.url
+        os.environ['NO_PROXY'] = os.environ['no_proxy'] = ''
+        self.cap = shards.RESULT_CAP
+        shards.RESULT_CAP = RESULT_CAP
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        os.environ.clear()
+        os.environ.update(self.env)
+        shards.RESULT_CAP = self.cap
+        shutil.rmtree(self.tmp)
+
+    def scraper(self, crash_after=None):
+        scraper = OfflineScraper(
+            domains=['http://sfbay.craigslist.org/search/apa'],
+            earliest_ts=self.server.start - timedelta(days=2),
+            latest_ts=self.server.start + timedelta(minutes=1),
+            out_dir=self.tmp + '/', fname_ts='T', checkpoint_dir=os.path.join(self.tmp, 'ck'),
+            resume=True, cache_dir=None, rate_limit=None, fips_cache=None, seen_pids=None,
+            prefetch_filter=None)
+        scraper.crash_after = crash_after
+        return scraper
+
+    def test_resume_sharded_region(self):
+        self.assertRaises(KeyboardInterrupt, self.scraper(crash_after=3).run, charity_proxy=False)
+        self.server.reset_counts()
+        stats = self.scraper().run(charity_proxy=False)[0]
+
+        with open(os.path.join(self.tmp, 'sfbay-T.csv')) as f:
+            pids = [row['pid'] for row in csv.DictReader(f)]
+        self.assertTrue(len(stats.get('shards', [])) > 0)
+        self.assertEqual(len(pids), len(set(pids)))
+        self.assertEqual(len(pids), LISTINGS)
+        self.assertEqual(stats['listings'], LISTINGS)
+        self.assertEqual(stats['rows'], LISTINGS)
+        # Pages fetched before the interruption aren't fetched again
+        self.assertEqual(self.server.counts['detail'], LISTINGS - 3 * replay_server.PAGE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
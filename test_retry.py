@@ -0,0 +1,158 @@
+# Unit tests for the retry policy and circuit breakers in scraper2/retry.py. Run with
+# python test_retry.py, or with pytest
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scraper2'))
+import requests
+import retry
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, content=b'<html></html>'):
+        self.status_code = status_code
+        self.content = content
+
+
+class FakeSend(object):
+    '''
+    Stands in for a request: returns or raises the given outcomes in turn, repeating
+    the last one, and counts how many times it was called.
+    '''
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def __call__(self):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_responses(self):
+        self.assertEqual(retry.classify(FakeResponse(200)), retry.OK)
+        self.assertEqual(retry.classify(FakeResponse(404)), retry.OK)
+        self.assertEqual(retry.classify(FakeResponse(503)), retry.RETRY)
+        self.assertEqual(retry.classify(FakeResponse(403)), retry.THROTTLED)
+        self.assertEqual(retry.classify(FakeResponse(429)), retry.THROTTLED)
+        block_page = FakeResponse(200, b'<p>This IP has been automatically blocked.</p>')
+        self.assertEqual(retry.classify(block_page), retry.THROTTLED)
+
+    def test_errors(self):
+        self.assertEqual(retry.classify(error=requests.exceptions.Timeout()), retry.RETRY)
+        self.assertEqual(retry.classify(error=requests.exceptions.ConnectionError()), retry.RETRY)
+        self.assertEqual(retry.classify(error=ValueError()), retry.FATAL)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_trips_after_failures_in_a_row(self):
+        breaker = retry.CircuitBreaker(3, 'test')
+        breaker.failure()
+        breaker.failure()
+        self.assertFalse(breaker.is_open)
+        breaker.check()
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        self.assertRaises(retry.CircuitOpen, breaker.check)
+
+    def test_success_resets_count(self):
+        breaker = retry.CircuitBreaker(3, 'test')
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        self.assertFalse(breaker.is_open)
+
+    def test_stays_open_after_success(self):
+        breaker = retry.CircuitBreaker(2, 'test')
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        self.assertTrue(breaker.is_open)
+        self.assertEqual(breaker.count, 2)
+
+    def test_trip(self):
+        breaker = retry.CircuitBreaker(3, 'test')
+        breaker.trip('throttled')
+        self.assertTrue(breaker.is_open)
+        try:
+            breaker.check()
+            self.fail('CircuitOpen not raised')
+        except retry.CircuitOpen as e:
+            self.assertEqual(str(e), 'test: throttled')
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def policy(self, retries=3, failures=100):
+        policy = retry.RetryPolicy(retries=retries, backoff=0, max_backoff=0)
+        policy.breaker = retry.CircuitBreaker(failures, 'test')
+        return policy
+
+    def test_ok(self):
+        send = FakeSend(FakeResponse(200))
+        policy = self.policy()
+        self.assertEqual(policy.call(send, 'url').status_code, 200)
+        self.assertEqual(send.calls, 1)
+
+    def test_retries_until_ok(self):
+        send = FakeSend(FakeResponse(503), requests.exceptions.Timeout(), FakeResponse(200))
+        policy = self.policy()
+        self.assertEqual(policy.call(send, 'url').status_code, 200)
+        self.assertEqual(send.calls, 3)
+        self.assertEqual(policy.breaker.count, 0)
+
+    def test_gives_up_after_retries(self):
+        send = FakeSend(FakeResponse(503))
+        policy = self.policy(retries=3)
+        self.assertRaises(retry.FetchFailed, policy.call, send, 'url')
+        self.assertEqual(send.calls, 4)
+        self.assertEqual(policy.breaker.count, 4)
+
+    def test_no_retries(self):
+        send = FakeSend(FakeResponse(503))
+        self.assertRaises(retry.FetchFailed, self.policy(retries=0).call, send, 'url')
+        self.assertEqual(send.calls, 1)
+
+    def test_throttled_is_not_retried(self):
+        send = FakeSend(FakeResponse(403), FakeResponse(200))
+        policy = self.policy()
+        self.assertRaises(retry.FetchFailed, policy.call, send, 'url')
+        self.assertEqual(send.calls, 1)
+        self.assertTrue(policy.breaker.is_open)
+
+    def test_fatal_error_is_raised(self):
+        send = FakeSend(ValueError('bad url'), FakeResponse(200))
+        self.assertRaises(ValueError, self.policy().call, send, 'url')
+        self.assertEqual(send.calls, 1)
+
+    def test_breaker_stops_retries(self):
+        send = FakeSend(FakeResponse(503))
+        policy = self.policy(retries=10, failures=2)
+        self.assertRaises(retry.CircuitOpen, policy.call, send, 'url')
+        self.assertEqual(send.calls, 2)
+
+    def test_open_breaker_sends_nothing(self):
+        send = FakeSend(FakeResponse(200))
+        policy = self.policy()
+        policy.breaker.trip('test')
+        self.assertRaises(retry.CircuitOpen, policy.call, send, 'url')
+        self.assertEqual(send.calls, 0)
+
+    def test_without_breaker(self):
+        send = FakeSend(FakeResponse(503), FakeResponse(200))
+        policy = retry.RetryPolicy(retries=3, backoff=0, max_backoff=0)
+        self.assertEqual(policy.call(send, 'url').status_code, 200)
+        self.assertEqual(send.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
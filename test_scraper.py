@@ -4,7 +4,7 @@ from datetime import timedelta
 import time
 import sys
 sys.path.insert(0, 'scraper2/')
-import w_brs
+import scraper2
 import csv
 
 __author__ = "Sam Maurer, UrbanSim Inc"
@@ -21,7 +21,7 @@ domains = ['http://sacramento.craigslist.org/search/apa']
 lookback = 1  # hours
 ts = dt.now().strftime('%Y%m%d-%H%M%S')
 st = time.time()
-s = w_brs.RentalListingScraper(
+s = scraper2.RentalListingScraper(
     domains=domains,
     earliest_ts=dt.now() - timedelta(hours=lookback),
     latest_ts=dt.now() + timedelta(hours=0),